@@ -0,0 +1,57 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# Copyright (c) 2020 neilk
+#
+# Replays the charge sensor selection logic over stored historical rates
+# Kept separate from plugin.py and free of the indigo module
+
+################################################################################
+# Backtest a single charge sensor configuration
+################################################################################
+def sorted_bucket_rates(days, charge_periods):
+    # days is a list of (local day, [(valid_from, rate), ...]) as held by the tariff device for each day
+    # charge_periods maps night/day/evening to the period times the charge sensor chooses from
+    # Matches periods the same way as the charge sensor, and sorts each day once for all configurations
+    bucket_rates = {}
+    for night_day, periods in charge_periods.items():
+        bucket_rates[night_day] = []
+        for day, day_rates in days:
+            bucket_rates[night_day].append(sorted(
+                [rate for valid_from, rate in day_rates if any(period + ":00" in valid_from for period in periods)]))
+    return bucket_rates
+
+
+def backtest_config(bucket_rates, energy_hours, max_rate, night_day, charger_kw):
+    # The sensor picks the cheapest energy_hours*2 periods in the chosen bucket, and charges in those under max_rate
+    periods_needed = energy_hours * 2
+    charged_periods = 0
+    total_cost = 0.0
+    missed_days = 0
+    for day_rates in bucket_rates[night_day]:
+        charged_today = 0
+        for rate in day_rates[0:periods_needed]:
+            if rate <= max_rate:
+                charged_today += 1
+                total_cost += rate * charger_kw * 0.5
+        if charged_today < periods_needed:
+            missed_days += 1
+        charged_periods += charged_today
+    energy_delivered = charged_periods * charger_kw * 0.5
+    if energy_delivered > 0:
+        average_price = total_cost / energy_delivered
+    else:
+        average_price = 0.0
+    return {'energy_hours': energy_hours, 'max_rate': max_rate, 'night_day': night_day,
+            'energy_delivered': energy_delivered, 'average_price': average_price, 'total_cost': total_cost,
+            'missed_days': missed_days, 'days': len(bucket_rates[night_day])}
+
+
+################################################################################
+# Sweep a grid of configurations
+################################################################################
+def run_sweep(days, charge_periods, configs, charger_kw):
+    # Runs in the calling thread, the plugin starts it on its own thread so the action returns straight away
+    bucket_rates = sorted_bucket_rates(days, charge_periods)
+    return [backtest_config(bucket_rates, energy_hours, max_rate, night_day, charger_kw)
+            for energy_hours, max_rate, night_day in configs]
@@ -13,12 +13,24 @@ import requests
 import json
 # import time
 import datetime
+import time
+import calendar
 import csv
 import os
 import base64
 import dateutil.parser
 import dateutil.tz
 import pytz
+import math
+import collections
+import heapq
+import array
+import bisect
+import re
+import threading
+import random
+import concurrent.futures
+import backtester
 
 ################################################################################
 # Globals
@@ -30,6 +42,33 @@ BASE_URL = "https://api.octopus.energy/v1"
 GET_GSP = "/industry/grid-supply-points/?postcode="
 # This is the product code for the Octopus Energy Agile Tariff which will return the 30 min rates when combined with a GSP
 PRODUCT_CODE = "AGILE-18-02-21"
+# and the Agile Outgoing product used for the export rate device
+# These are only used until the product catalog has been fetched, after which the current products are used
+EXPORT_PRODUCT_CODE = "AGILE-OUTGOING-19-05-13"
+# Product family and direction in the catalog for each rate device type, with the fallback product code
+PRODUCT_FAMILIES = {"OctopusEnergy": ("AGILE", "IMPORT", PRODUCT_CODE),
+                    "OctopusEnergyExport": ("AGILE-OUTGOING", "EXPORT", EXPORT_PRODUCT_CODE)}
+# Timeouts, connection errors, 429 and 5xx responses are retried this many times, waiting a random time up to
+# API_BACKOFF_BASE * 2^retry seconds (capped at API_BACKOFF_CAP) before each retry
+API_RETRIES = 2
+API_BACKOFF_BASE = 0.5
+API_BACKOFF_CAP = 8
+# Consecutive failed requests before an endpoint's circuit opens, and seconds before a trial request is let through
+API_CIRCUIT_THRESHOLD = 5
+API_CIRCUIT_COOLDOWN = 600
+# Indigo variable folder for the circuit state and retry count of each endpoint
+API_HEALTH_FOLDER = "Octopus Energy API"
+# Each endpoint's timeout is API_TIMEOUT_FACTOR times the 99th percentile of its last API_LATENCY_WINDOW response
+# times (never below the configured timeout nor above API_TIMEOUT_MAX), and a duplicate request is sent if the
+# first has not answered by the 95th percentile.  Both wait for API_LATENCY_MIN_SAMPLES responses
+API_LATENCY_WINDOW = 100
+API_LATENCY_MIN_SAMPLES = 20
+API_TIMEOUT_FACTOR = 2
+API_TIMEOUT_MAX = 30
+# Days after which an open ended (no valid_to) cached standing charge is checked again for a newly announced one
+STANDING_CHARGE_RECHECK_DAYS = 7
+# Seconds between background attempts to refresh rates while a device is serving stored (stale) rates
+RATES_REVALIDATE_INTERVAL = 300
 state_list = ["From-00-00", "From-00-30", "From-01-00", "From-01-30", "From-02-00", "From-02-30", "From-03-00",
               "From-03-30", "From-04-00", "From-04-30", "From-05-00", "From-05-30", "From-06-00", "From-06-30",
               "From-07-00", "From-07-30", "From-08-00", "From-08-30", "From-09-00", "From-09-30", "From-10-00",
@@ -86,6 +125,818 @@ go_options = {
 }
 
 
+def compile_go_schedule(go_periods):
+    # Reduce a Go period list to the points in the day where the rate actually changes
+    # Returns a list of (minutes after midnight, True if the Go rate applies from that point)
+    changes = []
+    for slot in range(48):
+        in_go = state_list[slot] in go_periods
+        if in_go != (state_list[slot - 1] in go_periods):
+            changes.append((slot * 30, in_go))
+    return changes
+
+
+# Compiled once, Go devices only need to look at these to find the next rate change
+go_schedules = dict((go_tariff, compile_go_schedule(go_periods)) for go_tariff, go_periods in go_options.items())
+
+
+def next_go_rate_change(go_tariff, now):
+    # Find the next local time after now that the Go rate changes, and if it changes to the Go rate
+    midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    for day in range(2):
+        for minutes, in_go in go_schedules[go_tariff]:
+            change_time = midnight + datetime.timedelta(days=day, minutes=minutes)
+            if change_time > now:
+                return change_time, in_go
+    return None, None
+
+
+def slot_key(timestamp):
+    # Rates are reported in UTC (Z) but consumption in local time, so normalise both to a UTC key for the history store
+    slot_time = dateutil.parser.parse(timestr=timestamp).astimezone(dateutil.tz.tzutc())
+    return slot_time.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def slot_local_time(key):
+    # Convert a history store key back to local time
+    return dateutil.parser.parse(timestr=key).astimezone(dateutil.tz.tzlocal())
+
+
+def period_after(key, periods=1):
+    # The history store key for a number of half hour periods after the given key
+    period_time = datetime.datetime.strptime(key, "%Y-%m-%dT%H:%M:%SZ") + datetime.timedelta(minutes=30 * periods)
+    return period_time.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def cheapest_contiguous_start(horizon, profile):
+    # Slide the energy profile (kWh in each half hour of the run) along the rate horizon [(period, rate), ...]
+    # and return (index into horizon, cost) for the cheapest start, or (None, None) if the run does not fit
+    # The run must use consecutive periods, so count how many contiguous periods follow each one first
+    contiguous = [1] * len(horizon)
+    for index in range(len(horizon) - 2, -1, -1):
+        if horizon[index + 1][0] == period_after(horizon[index][0]):
+            contiguous[index] = contiguous[index + 1] + 1
+    best_index = None
+    best_cost = None
+    for index in range(len(horizon) - len(profile) + 1):
+        if contiguous[index] < len(profile):
+            continue
+        cost = sum(energy * horizon[index + offset][1] for offset, energy in enumerate(profile))
+        if best_cost is None or cost < best_cost:
+            best_index = index
+            best_cost = cost
+    return best_index, best_cost
+
+
+def plan_battery(rates, capacity_kwh, charge_kwh, discharge_kwh, efficiency, reserve_kwh, soc_kwh, step_kwh):
+    # Dynamic program over the rate periods to choose charge / hold / discharge for a home battery
+    # The state of charge is held in steps of step_kwh, charge_kwh and discharge_kwh are the most that can be
+    # moved in a half hour and the round trip efficiency is split evenly between charging and discharging
+    # Energy left at the end of the horizon is valued at the median rate so the plan doesn't simply empty the battery
+    # Returns (list of actions for each period, state of charge at the start of each period, saving against holding)
+    charge_efficiency = math.sqrt(efficiency)
+    levels = int(round(capacity_kwh / step_kwh)) + 1
+    min_level = min(int(math.ceil(round(reserve_kwh / step_kwh, 6))), levels - 1)
+    start_level = max(0, min(int(round(soc_kwh / step_kwh)), levels - 1))
+    charge_steps = max(1, int(charge_kwh * charge_efficiency / step_kwh))
+    discharge_steps = max(1, int(discharge_kwh / step_kwh))
+    stored_value = sorted(rates)[len(rates) // 2] * charge_efficiency * step_kwh if rates else 0
+
+    # Work backwards from the end of the horizon, keeping the best cost to go and the action for each level
+    cost_to_go = [-level * stored_value for level in range(levels)]
+    policy = []
+    for rate in reversed(rates):
+        charge_cost = rate * step_kwh / charge_efficiency
+        discharge_value = rate * step_kwh * charge_efficiency
+        period_cost = []
+        period_policy = []
+        for level in range(levels):
+            best_cost = cost_to_go[level]
+            best_move = 0
+            up = min(charge_steps, levels - 1 - level)
+            if up > 0:
+                cost = up * charge_cost + cost_to_go[level + up]
+                if cost < best_cost:
+                    best_cost = cost
+                    best_move = up
+            down = min(discharge_steps, level - min_level)
+            if down > 0:
+                cost = cost_to_go[level - down] - down * discharge_value
+                if cost < best_cost:
+                    best_cost = cost
+                    best_move = -down
+            period_cost.append(best_cost)
+            period_policy.append(best_move)
+        cost_to_go = period_cost
+        policy.append(period_policy)
+    policy.reverse()
+
+    # Then follow the policy forwards from the current state of charge
+    actions = []
+    soc = []
+    level = start_level
+    for period_policy in policy:
+        soc.append(level * step_kwh)
+        move = period_policy[level]
+        if move > 0:
+            actions.append("charge")
+        elif move < 0:
+            actions.append("discharge")
+        else:
+            actions.append("hold")
+        level += move
+    hold_cost = -start_level * stored_value
+    return actions, soc, hold_cost - cost_to_go[start_level]
+
+
+def greedy_load_schedule(loads, capacity_kw):
+    # loads is a list of (candidate periods {period: rate}, periods needed, kW) for each load
+    # Give out the cheapest periods first, to any load that still needs them and fits under the supply capacity
+    plans = [{} for load in loads]
+    period_load = {}
+    candidates = sorted((rate, index, period) for index, (periods, periods_needed, load_kw) in enumerate(loads)
+                        for period, rate in periods.items())
+    for rate, index, period in candidates:
+        periods, periods_needed, load_kw = loads[index]
+        if len(plans[index]) < periods_needed and period_load.get(period, 0) + load_kw <= capacity_kw + 0.0001:
+            plans[index][period] = rate
+            period_load[period] = period_load.get(period, 0) + load_kw
+    return plans
+
+
+def min_cost_flow_load_schedule(loads, capacity_kw):
+    # Same inputs as greedy_load_schedule, but solved jointly as a min cost flow
+    # source -> load (periods needed) -> period (1 each, cost rate x kW) -> sink (loads that fit in the period)
+    # A flow can only count loads, so each period allows as many loads as fit at the largest kW that could use it
+    nodes = {'source': 0, 'sink': 1}
+    graph = [[], []]
+
+    def node(name):
+        if name not in nodes:
+            nodes[name] = len(graph)
+            graph.append([])
+        return nodes[name]
+
+    def add_edge(start, end, capacity, cost):
+        # Each edge is [end, remaining capacity, cost, index of the reverse edge]
+        graph[start].append([end, capacity, cost, len(graph[end])])
+        graph[end].append([start, 0, -cost, len(graph[start]) - 1])
+
+    period_kw = {}
+    for index, (periods, periods_needed, load_kw) in enumerate(loads):
+        add_edge(0, node(('load', index)), periods_needed, 0)
+        for period, rate in periods.items():
+            add_edge(node(('load', index)), node(('period', period)), 1, rate * load_kw)
+            period_kw[period] = max(period_kw.get(period, 0), load_kw)
+    for period, largest_kw in period_kw.items():
+        add_edge(node(('period', period)), 1, int((capacity_kw + 0.0001) // largest_kw), 0)
+
+    # Successive shortest paths, using Bellman-Ford (queue based) as negative rates give negative costs
+    while True:
+        distance = [None] * len(graph)
+        previous = [None] * len(graph)
+        distance[0] = 0
+        queue = collections.deque([0])
+        queued = set([0])
+        while queue:
+            start = queue.popleft()
+            queued.discard(start)
+            for edge_index, (end, capacity, cost, reverse) in enumerate(graph[start]):
+                if capacity > 0 and (distance[end] is None or distance[start] + cost < distance[end] - 1e-9):
+                    distance[end] = distance[start] + cost
+                    previous[end] = (start, edge_index)
+                    if end not in queued:
+                        queue.append(end)
+                        queued.add(end)
+        if distance[1] is None:
+            break
+        # Every edge into a period has capacity 1, so each path carries a single period for a single load
+        end = 1
+        while end != 0:
+            start, edge_index = previous[end]
+            edge = graph[start][edge_index]
+            edge[1] -= 1
+            graph[end][edge[3]][1] += 1
+            end = start
+
+    # A used load to period edge has no capacity left
+    names = dict((node_index, name) for name, node_index in nodes.items())
+    plans = [{} for load in loads]
+    for index, (periods, periods_needed, load_kw) in enumerate(loads):
+        for end, capacity, cost, reverse in graph[nodes[('load', index)]]:
+            if names[end][0] == 'period' and capacity == 0:
+                plans[index][names[end][1]] = periods[names[end][1]]
+    return plans
+
+
+def rate_crossings(horizon, condition):
+    # Return the periods in the horizon [(period, rate), ...] where the condition on the rate becomes true
+    # The first period is only used as the starting point, as any crossing into it has already happened
+    crossings = []
+    for index in range(1, len(horizon)):
+        if condition(horizon[index][1]) and not condition(horizon[index - 1][1]):
+            crossings.append(horizon[index][0])
+    return crossings
+
+
+def histogram_quantiles(histogram, quantiles, bin_width):
+    # histogram maps a rate bin (rate // bin_width) to a count, returns the rate at each quantile (0-100)
+    total = sum(histogram.values())
+    results = []
+    if total == 0:
+        return results
+    bins = sorted(histogram.items())
+    for quantile in quantiles:
+        target = total * quantile / 100.0
+        seen = 0
+        for rate_bin, count in bins:
+            seen += count
+            if seen >= target:
+                results.append(round((rate_bin + 0.5) * bin_width, 4))
+                break
+    return results
+
+
+def price_band(rate, band, cheap_threshold, expensive_threshold, hysteresis):
+    # Bands only change once the rate has moved past the threshold by the hysteresis margin
+    if rate < 0:
+        return "plunge"
+    if rate <= cheap_threshold or (band in ("cheap", "plunge") and rate < cheap_threshold + hysteresis):
+        return "cheap"
+    if rate >= expensive_threshold or (band == "expensive" and rate > expensive_threshold - hysteresis):
+        return "expensive"
+    return "normal"
+
+
+def band_timeline(horizon, band, cheap_threshold, expensive_threshold, hysteresis):
+    # Returns the band for each period in the horizon [(period, rate), ...] starting from the current band
+    timeline = []
+    for period, rate in horizon:
+        band = price_band(rate, band, cheap_threshold, expensive_threshold, hysteresis)
+        timeline.append((period, band))
+    return timeline
+
+
+def local_day_slot(key):
+    # The local day of a history store key and the half hour slot within it (0-49, to allow for the long DST day)
+    # Uses the time module's local time conversions as this is called for every period when history is loaded
+    epoch = calendar.timegm(datetime.datetime.strptime(key, "%Y-%m-%dT%H:%M:%SZ").timetuple())
+    local_time = time.localtime(epoch)
+    local_midnight = time.mktime((local_time.tm_year, local_time.tm_mon, local_time.tm_mday, 0, 0, 0, 0, 0, -1))
+    return datetime.date(local_time.tm_year, local_time.tm_mon, local_time.tm_mday), int((epoch - local_midnight) // 1800)
+
+
+class ConsumptionRing(object):
+    # Fixed size array backed store of half hourly usage and cost for one meter, a row of 50 slots per local day
+    # Rows are reused once they are older than the ring, and the 7 day, 30 day, month and year to date totals are
+    # kept up to date as each slot is added, so they never need the history to be summed again
+
+    slots_per_day = 50
+
+    def __init__(self, days=400):
+        self.days = days
+        self.usage = array.array('d', [0.0]) * (days * self.slots_per_day)
+        self.cost = array.array('d', [0.0]) * (days * self.slots_per_day)
+        self.day_usage = array.array('d', [0.0]) * days
+        self.day_cost = array.array('d', [0.0]) * days
+        self.first_day = None
+        self.last_day = None
+        self.month = None
+        self.year = None
+        self.totals = {7: [0.0, 0.0], 30: [0.0, 0.0], 'month': [0.0, 0.0], 'year': [0.0, 0.0]}
+
+    def advance(self, day_number):
+        # Move the newest day on, clearing each reused row and dropping the days that leave the rolling windows
+        if self.last_day is None or day_number - self.last_day >= self.days:
+            self.__init__(self.days)
+            self.last_day = day_number - 1
+        while self.last_day < day_number:
+            self.last_day += 1
+            row = self.last_day % self.days
+            for slot in range(row * self.slots_per_day, (row + 1) * self.slots_per_day):
+                self.usage[slot] = 0.0
+                self.cost[slot] = 0.0
+            self.day_usage[row] = 0.0
+            self.day_cost[row] = 0.0
+            for window in (7, 30):
+                leaving = (self.last_day - window) % self.days
+                self.totals[window][0] -= self.day_usage[leaving]
+                self.totals[window][1] -= self.day_cost[leaving]
+            day = datetime.date.fromordinal(self.last_day)
+            if (day.year, day.month) != self.month:
+                self.month = (day.year, day.month)
+                self.totals['month'] = [0.0, 0.0]
+            if day.year != self.year:
+                self.year = day.year
+                self.totals['year'] = [0.0, 0.0]
+
+    def add(self, day, slot, usage, cost):
+        day_number = day.toordinal()
+        if self.last_day is None or day_number > self.last_day:
+            self.advance(day_number)
+        elif day_number <= self.last_day - self.days:
+            return
+        if self.first_day is None or day_number < self.first_day:
+            self.first_day = day_number
+        row = day_number % self.days
+        position = row * self.slots_per_day + slot
+        usage_change = usage - self.usage[position]
+        cost_change = cost - self.cost[position]
+        self.usage[position] = usage
+        self.cost[position] = cost
+        self.day_usage[row] += usage_change
+        self.day_cost[row] += cost_change
+        for window in (7, 30):
+            if day_number > self.last_day - window:
+                self.totals[window][0] += usage_change
+                self.totals[window][1] += cost_change
+        if (day.year, day.month) == self.month:
+            self.totals['month'][0] += usage_change
+            self.totals['month'][1] += cost_change
+        if day.year == self.year:
+            self.totals['year'][0] += usage_change
+            self.totals['year'][1] += cost_change
+
+    def daily_average(self):
+        # Average (usage, cost) per day over the last 30 days, or fewer if the ring does not hold 30 days yet
+        if self.last_day is None:
+            return 0.0, 0.0
+        days = min(30, self.last_day - max(self.first_day, self.last_day - self.days + 1) + 1)
+        return self.totals[30][0] / days, self.totals[30][1] / days
+
+    def to_date(self, today):
+        # (usage, cost, days of data) for the month and year of today, from the totals up to the newest day held
+        # The days only count from the first day held, so a history starting part way through is not overstated
+        if self.last_day is None:
+            return (0.0, 0.0, 0), (0.0, 0.0, 0)
+        first_day = max(self.first_day, self.last_day - self.days + 1)
+        if self.month == (today.year, today.month):
+            month_start = datetime.date(today.year, today.month, 1).toordinal()
+            month = (self.totals['month'][0], self.totals['month'][1], self.last_day - max(first_day, month_start) + 1)
+        else:
+            month = (0.0, 0.0, 0)
+        if self.year == today.year:
+            year_start = datetime.date(today.year, 1, 1).toordinal()
+            year = (self.totals['year'][0], self.totals['year'][1], self.last_day - max(first_day, year_start) + 1)
+        else:
+            year = (0.0, 0.0, 0)
+        return month, year
+
+
+def local_day_keys(day):
+    # The history store keys for each half hour slot of a local day, as a list of (slot, key)
+    start = datetime.datetime.combine(day, datetime.time(0), tzinfo=dateutil.tz.tzlocal()).astimezone(dateutil.tz.tzutc())
+    end = datetime.datetime.combine(day + datetime.timedelta(days=1), datetime.time(0),
+                                    tzinfo=dateutil.tz.tzlocal()).astimezone(dateutil.tz.tzutc())
+    keys = []
+    while start < end:
+        keys.append((len(keys), start.strftime("%Y-%m-%dT%H:%M:%SZ")))
+        start = start + datetime.timedelta(minutes=30)
+    return keys
+
+
+def group_by_local_day(entries):
+    # Split {period: value} into a time ordered list of (local day, {slot: value})
+    days = collections.OrderedDict()
+    for key in sorted(entries):
+        day, slot = local_day_slot(key)
+        days.setdefault(day, {})[slot] = entries[key]
+    return list(days.items())
+
+
+class ConsumptionForecast(object):
+    # Exponentially weighted mean usage for each half hour slot of each weekday
+    # Each slot is only ever added once, so training is incremental as the consumption arrives
+    # Slots arriving late (e.g. the previous day's 23:30 in the next batch) are merged for up to late_days
+
+    slots_per_day = 50
+    late_days = 7
+
+    def __init__(self, alpha=0.3):
+        self.alpha = alpha
+        self.means = array.array('d', [0.0]) * (7 * self.slots_per_day)
+        self.seen = array.array('b', [0]) * (7 * self.slots_per_day)
+        self.last_day = None
+        self.added = {}
+
+    def add_day(self, day, slots):
+        day_number = day.toordinal()
+        if self.last_day is not None and day_number <= self.last_day - self.late_days:
+            return
+        added = self.added.setdefault(day_number, set())
+        for slot, usage in slots.items():
+            if slot in added:
+                continue
+            added.add(slot)
+            position = day.weekday() * self.slots_per_day + slot
+            if self.seen[position]:
+                self.means[position] += self.alpha * (usage - self.means[position])
+            else:
+                self.means[position] = usage
+                self.seen[position] = 1
+        self.last_day = max(self.last_day or day_number, day_number)
+        for old_day in [old_day for old_day in self.added if old_day <= self.last_day - self.late_days]:
+            del self.added[old_day]
+
+    def expected(self, day, slot):
+        position = day.weekday() * self.slots_per_day + slot
+        if self.seen[position]:
+            return self.means[position]
+        return None
+
+
+def sorted_median(values):
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+class SlotBaseline(object):
+    # Rolling window of the last 28 days of usage for each half hour slot, kept sorted for the median and MAD
+    # Slots arriving late (e.g. the previous day's 23:30 in the next batch) are merged for up to late_days
+
+    slots_per_day = 50
+    window = 28
+    late_days = 7
+
+    def __init__(self):
+        self.history = [collections.deque() for slot in range(self.slots_per_day)]
+        self.ordered = [[] for slot in range(self.slots_per_day)]
+        self.last_day = None
+        self.added = {}
+
+    def add_day(self, day, slots):
+        day_number = day.toordinal()
+        if self.last_day is not None and day_number <= self.last_day - self.late_days:
+            return
+        added = self.added.setdefault(day_number, set())
+        for slot, usage in slots.items():
+            if slot in added:
+                continue
+            added.add(slot)
+            self.history[slot].append(usage)
+            bisect.insort(self.ordered[slot], usage)
+            if len(self.history[slot]) > self.window:
+                oldest = self.history[slot].popleft()
+                del self.ordered[slot][bisect.bisect_left(self.ordered[slot], oldest)]
+        self.last_day = max(self.last_day or day_number, day_number)
+        for old_day in [old_day for old_day in self.added if old_day <= self.last_day - self.late_days]:
+            del self.added[old_day]
+
+    def score(self, slots, floor=0.05):
+        # Robust z score of each slot against its baseline, for slots with at least a week of history
+        # The floor (kWh) stops a perfectly steady slot scoring very highly for a tiny change
+        scores = {}
+        for slot, usage in slots.items():
+            ordered = self.ordered[slot]
+            if len(ordered) < 7:
+                continue
+            median = sorted_median(ordered)
+            mad = sorted_median(sorted(abs(value - median) for value in ordered))
+            scores[slot] = abs(usage - median) / (1.4826 * mad + floor)
+        return scores
+
+
+class P2Quantile(object):
+    # Streaming quantile estimate using the P-squared algorithm (Jain and Chlamtac)
+    # Five markers are adjusted as each value arrives, so no values need to be kept
+
+    def __init__(self, quantile):
+        self.quantile = quantile
+        self.heights = []
+        self.positions = [1, 2, 3, 4, 5]
+        self.desired = [1, 1 + 2 * quantile, 1 + 4 * quantile, 3 + 2 * quantile, 5]
+        self.increments = [0, quantile / 2, quantile, (1 + quantile) / 2, 1]
+        self.count = 0
+
+    def add(self, value):
+        self.count += 1
+        heights = self.heights
+        positions = self.positions
+        if len(heights) < 5:
+            bisect.insort(heights, value)
+            return
+        if value < heights[0]:
+            heights[0] = value
+            cell = 0
+        elif value >= heights[4]:
+            heights[4] = value
+            cell = 3
+        else:
+            cell = bisect.bisect_right(heights, value) - 1
+        for index in range(cell + 1, 5):
+            positions[index] += 1
+        for index in range(5):
+            self.desired[index] += self.increments[index]
+        for index in range(1, 4):
+            offset = self.desired[index] - positions[index]
+            if (offset >= 1 and positions[index + 1] - positions[index] > 1) or \
+                    (offset <= -1 and positions[index - 1] - positions[index] < -1):
+                step = 1 if offset > 0 else -1
+                height = heights[index] + step / float(positions[index + 1] - positions[index - 1]) * (
+                    (positions[index] - positions[index - 1] + step) * (heights[index + 1] - heights[index]) /
+                    float(positions[index + 1] - positions[index]) +
+                    (positions[index + 1] - positions[index] - step) * (heights[index] - heights[index - 1]) /
+                    float(positions[index] - positions[index - 1]))
+                if not heights[index - 1] < height < heights[index + 1]:
+                    height = heights[index] + step * (heights[index + step] - heights[index]) / float(
+                        positions[index + step] - positions[index])
+                heights[index] = height
+                positions[index] += step
+
+    def value(self):
+        if self.count == 0:
+            return None
+        if len(self.heights) < 5 or self.count < 5:
+            return self.heights[min(len(self.heights) - 1, int(self.quantile * len(self.heights)))]
+        return self.heights[2]
+
+
+class BaseloadEstimate(object):
+    # Low quantile of the overnight (00:00 to 05:00 local) half hour usage, taken as the always on load
+
+    overnight_slots = 10
+
+    def __init__(self, quantile=0.1):
+        self.estimate = P2Quantile(quantile)
+        self.last_day = None
+
+    def add_day(self, day, slots):
+        if self.last_day is not None and day.toordinal() <= self.last_day:
+            return
+        for slot, usage in slots.items():
+            if slot < self.overnight_slots:
+                self.estimate.add(usage)
+        self.last_day = day.toordinal()
+
+    def kw(self):
+        usage = self.estimate.value()
+        if usage is None:
+            return None
+        return usage * 2
+
+
+def net_import_export(keys, import_usage, import_rates, export_usage, export_rates):
+    # One pass over the periods joining both meters and both rate series, returns the cost for each period
+    # as (period, import cost, export earnings, net cost) and the totals for all the periods
+    periods = []
+    totals = [0.0, 0.0, 0.0]
+    for key in keys:
+        import_cost = import_usage.get(key, 0.0) * import_rates.get(key, 0.0)
+        export_earnings = export_usage.get(key, 0.0) * export_rates.get(key, 0.0)
+        periods.append((key, import_cost, export_earnings, import_cost - export_earnings))
+        totals[0] += import_cost
+        totals[1] += export_earnings
+        totals[2] += import_cost - export_earnings
+    return periods, totals
+
+
+def product_family(code):
+    # Product codes are the family followed by the launch date, e.g. AGILE-18-02-21 is in the AGILE family
+    return re.sub(r"-\d{2}-\d{2}-\d{2}$", "", code)
+
+
+def index_products(products):
+    # Index the /products/ results by code, and list the codes in each family in order of availability
+    catalog = {'products': {}, 'families': {}}
+    for product in products:
+        entry = {'family': product_family(product['code']), 'direction': product.get('direction', "IMPORT"),
+                 'available_from': None, 'available_to': None, 'regions': {}}
+        for field in ('available_from', 'available_to'):
+            if product.get(field):
+                entry[field] = slot_key(product[field])
+        catalog['products'][product['code']] = entry
+        catalog['families'].setdefault(entry['family'], []).append(product['code'])
+    for codes in catalog['families'].values():
+        codes.sort(key=lambda code: catalog['products'][code]['available_from'] or "")
+    return catalog
+
+
+def current_product(catalog, family, direction, now_key):
+    # The most recently launched product in the family (e.g. AGILE but not AGILE-FLEX) that is available now
+    current = None
+    for catalog_family, codes in catalog.get('families', {}).items():
+        if catalog_family != family:
+            continue
+        for code in codes:
+            product = catalog['products'][code]
+            if product['direction'] != direction or (product['available_from'] or "") > now_key:
+                continue
+            if product['available_to'] is not None and product['available_to'] <= now_key:
+                continue
+            if current is None or (product['available_from'] or "") > (catalog['products'][current]['available_from'] or ""):
+                current = code
+    return current
+
+
+def agreement_rates(keys, agreements, series_lookup):
+    # Join periods to the tariff agreement active in each (sorted [(from key, to key or None, tariff code)])
+    # and to that tariff's rate series, returning {period: rate} for the periods that have a rate
+    starts = [agreement[0] for agreement in agreements]
+    series = {}
+    rates = {}
+    for key in keys:
+        index = bisect.bisect_right(starts, key) - 1
+        if index < 0:
+            continue
+        valid_from, valid_to, tariff_code = agreements[index]
+        if valid_to is not None and key >= valid_to:
+            continue
+        if tariff_code not in series:
+            series[tariff_code] = series_lookup(tariff_code)
+        if key in series[tariff_code]:
+            rates[key] = series[tariff_code][key]
+    return rates
+
+
+class TokenBucket(object):
+    # Allows a burst of up to capacity requests, then rate requests a second
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def refill(self):
+        now = time.time()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self):
+        with self.lock:
+            self.refill()
+            if self.tokens >= 1:
+                return 0.0
+            return (1 - self.tokens) / self.rate
+
+    def take(self):
+        with self.lock:
+            self.refill()
+            self.tokens -= 1
+
+
+def api_endpoint(url):
+    # The kind of data a request fetches, each has its own circuit so one failing endpoint does not stop the others
+    for marker, endpoint in (("/standard-unit-rates/", "Rates"), ("/standing-charges/", "Standing_Charges"),
+                             ("/consumption/", "Consumption"), ("/accounts/", "Account"),
+                             ("/grid-supply-points/", "GSP"), ("/products/", "Products")):
+        if marker in url:
+            return endpoint
+    return "Other"
+
+
+class CircuitBreaker(object):
+    # Closed lets requests through, it opens after threshold consecutive failures and refuses requests for
+    # cooldown seconds, then lets a single trial request through (half-open) which closes it again if it succeeds
+
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.retries = 0
+        self.opened = None
+        self.trial = False
+        self.lock = threading.Lock()
+
+    def state(self):
+        if self.opened is None:
+            return "closed"
+        if self.trial or time.time() >= self.opened + self.cooldown:
+            return "half-open"
+        return "open"
+
+    def allow(self):
+        with self.lock:
+            if self.opened is None:
+                return True
+            if self.trial or time.time() < self.opened + self.cooldown:
+                return False
+            self.trial = True
+            return True
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened = None
+            self.trial = False
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            # A failed trial request opens the circuit for another cooldown
+            if self.failures >= self.threshold or self.trial:
+                self.opened = time.time()
+            self.trial = False
+
+
+class LatencyWindow(object):
+    # Response times (seconds) of an endpoint's recent requests, a timed out request counts as its timeout
+
+    def __init__(self, size, min_samples):
+        self.samples = collections.deque(maxlen=size)
+        self.min_samples = min_samples
+        self.lock = threading.Lock()
+
+    def add(self, seconds):
+        with self.lock:
+            self.samples.append(seconds)
+
+    def quantile(self, q):
+        # None until there are enough samples to be useful
+        with self.lock:
+            ordered = sorted(self.samples)
+        if len(ordered) < self.min_samples:
+            return None
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def timeout(self, floor):
+        p99 = self.quantile(0.99)
+        if p99 is None:
+            return floor
+        return min(API_TIMEOUT_MAX, max(floor, p99 * API_TIMEOUT_FACTOR))
+
+
+def fair_order(device_ids, account_of, round_number):
+    # Interleave the devices one account at a time, starting with a different account each round
+    queues = collections.OrderedDict()
+    for device_id in device_ids:
+        queues.setdefault(account_of(device_id), collections.deque()).append(device_id)
+    accounts = list(queues)
+    if accounts:
+        start = round_number % len(accounts)
+        accounts = accounts[start:] + accounts[:start]
+    order = []
+    while accounts:
+        for account in list(accounts):
+            order.append(queues[account].popleft())
+            if not queues[account]:
+                accounts.remove(account)
+    return order
+
+
+def standing_charge_on(charges, key):
+    # charges is a list of {'valid_from', 'valid_to', 'value_inc_vat'} with slot keys ("" / None when open ended)
+    # Returns the standing charge in effect at the slot key, or None if the charges do not cover it
+    for charge in charges:
+        if charge['valid_from'] <= key and (charge['valid_to'] is None or key < charge['valid_to']):
+            return charge['value_inc_vat']
+    return None
+
+
+def standing_charge_days(charges):
+    # Converts the charges to [(first local day ordinal, end day ordinal, daily charge)] (None when open ended),
+    # a charge applies to the local days that start within its window, as for standing_charge_on
+    def first_day(key):
+        local = slot_local_time(key)
+        if local.time() == datetime.time(0):
+            return local.date().toordinal()
+        return local.date().toordinal() + 1
+
+    return [(first_day(charge['valid_from']) if charge['valid_from'] else None,
+             first_day(charge['valid_to']) if charge['valid_to'] is not None else None,
+             charge['value_inc_vat']) for charge in charges]
+
+
+def standing_charge_total(charge_days, default, first_day, end_day):
+    # Sum of the daily standing charges for the local day ordinals from first_day up to (not including) end_day,
+    # using the default for days the charges do not cover
+    total = 0.0
+    covered = 0
+    for charge_from, charge_to, charge in charge_days:
+        start = first_day if charge_from is None else max(charge_from, first_day)
+        end = end_day if charge_to is None else min(charge_to, end_day)
+        if end > start:
+            total += (end - start) * charge
+            covered += end - start
+    return total + max(end_day - first_day - covered, 0) * default
+
+
+def compare_tariffs(consumption, tariffs):
+    # Cost the stored consumption against a number of tariffs in a single pass over the half hour periods
+    # tariffs is a list of (rate lookup, standing charge lookup), where the rate lookup returns None if the rate is
+    # unknown and the standing charge lookup returns the daily standing charge for a local day
+    # Returns {local day: [cost for each tariff]}, only for days where every tariff has a rate for every period
+    day_costs = {}
+    incomplete_days = set()
+    for key, kwh in consumption.items():
+        day = str(slot_local_time(key).date())
+        if day in incomplete_days:
+            continue
+        rates = [rate_lookup(key) for rate_lookup, standing_lookup in tariffs]
+        if None in rates:
+            incomplete_days.add(day)
+            day_costs.pop(day, None)
+            continue
+        if day not in day_costs:
+            day_costs[day] = [standing_lookup(day) for rate_lookup, standing_lookup in tariffs]
+        costs = day_costs[day]
+        for tariff_index, rate in enumerate(rates):
+            costs[tariff_index] += kwh * rate
+    return day_costs
+
 
 
 
@@ -100,6 +951,55 @@ class Plugin(indigo.PluginBase):
         super(Plugin, self).__init__(pluginId, pluginDisplayName, pluginVersion, pluginPrefs)
         self.debug = pluginPrefs.get("showDebugInfo", False)
         self.deviceList = []
+        # Devices that know when they next need an update (e.g. Go rate changes) are skipped until then
+        self.deviceTimers = {}
+        # History files already loaded from disk, keyed by name, and the lock serialising their loads and stores
+        # (the update loop, the catalog and background rate threads all use them)
+        self.historyCache = {}
+        self.historyLock = threading.RLock()
+        # Charge plans for energy target charge sensors, only recalculated when the rates or target change
+        self.chargePlans = {}
+        # Planned runs for appliance schedulers, recalculated on the same basis
+        self.appliancePlans = {}
+        # Battery schedules, only recalculated when new rates arrive
+        self.batteryPlans = {}
+        # Charge sensor plans set by a load coordinator, keyed by the charge sensor id
+        self.coordinatedPlans = {}
+        # Plugin event triggers being processed, and a heap of (local time, trigger id) when they are due to fire
+        # The heap is changed from both trigger callbacks and the concurrent thread so is only used under eventLock
+        self.triggers = {}
+        self.eventTimers = []
+        self.eventLock = threading.Lock()
+        # Start times (local) of the cheapest windows for each tariff device, keyed by the window length in periods
+        self.cheapestWindows = {}
+        # Daily rate histograms for each rate history, and the precomputed price band for each future period
+        self.rateSketches = {}
+        self.bandTimelines = {}
+        # Rolling usage and cost, and the usage forecast, for each meter keyed by the consumption history name
+        self.consumptionRings = {}
+        self.consumptionForecasts = {}
+        self.consumptionBaselines = {}
+        self.consumptionBaseloads = {}
+        # Shared connection to the Octopus API, and successful responses kept for a few minutes by URL
+        self.apiSession = requests.Session()
+        self.apiCache = {}
+        # The cache, buckets, breakers and latency windows are shared by the update loop and the background rate and
+        # catalog threads, so are only looked up, created or changed under apiLock
+        self.apiLock = threading.Lock()
+        # Request limits for each API key (None for devices that never call the API), and the scheduling round
+        self.apiBuckets = {}
+        self.apiRound = 0
+        # Circuit breaker for each endpoint, and the (state, retries) last written to its Indigo variables
+        self.apiBreakers = {}
+        self.apiHealth = {}
+        # Recent response times for each endpoint, and the threads requests (and their hedges) are sent from
+        self.apiLatencies = {}
+        self.apiExecutor = concurrent.futures.ThreadPoolExecutor(max_workers=4)
+        # Background refresh of today's rates for devices serving stored rates after an API failure
+        self.rateThreads = {}
+        # Background revalidation of the product catalog, and when it was last attempted
+        self.catalogThread = None
+        self.catalogAttempted = None
 
     ########################################
     def deviceStartComm(self, device):
@@ -110,17 +1010,43 @@ class Plugin(indigo.PluginBase):
             newProps = device.pluginProps
             newProps['address'] = "Charging Sensor"
             device.replacePluginPropsOnServer(newProps)
+        if device.deviceTypeId == "appliance_scheduler":
+            newProps = device.pluginProps
+            newProps['address'] = "Appliance Scheduler"
+            device.replacePluginPropsOnServer(newProps)
+        if device.deviceTypeId == "battery_optimizer":
+            newProps = device.pluginProps
+            newProps['address'] = "Battery Optimiser"
+            device.replacePluginPropsOnServer(newProps)
+        if device.deviceTypeId == "load_coordinator":
+            newProps = device.pluginProps
+            newProps['address'] = str(device.pluginProps['capacity_kw']) + " kW"
+            device.replacePluginPropsOnServer(newProps)
         if device.deviceTypeId == "OctopusEnergy_consumption":
             newProps = device.pluginProps
-            if device.pluginProps['meter_type'] == 'electricity' and device.pluginProps['calc_costs_yest']:
+            if device.pluginProps.get('export_meter', False) and device.pluginProps['meter_type'] == 'electricity':
+                newProps['address'] = "Electricity Export"
+            elif device.pluginProps['meter_type'] == 'electricity' and device.pluginProps['calc_costs_yest']:
                 newProps['address'] = "Electricity Cost"
             elif device.pluginProps['meter_type'] == 'electricity' and not (device.pluginProps['calc_costs_yest']):
                 newProps['address'] = "Electricity Usage"
             else:
                 newProps['address'] = "Gas Usage"
             device.replacePluginPropsOnServer(newProps)
+        if device.deviceTypeId == "OctopusEnergy_comparison":
+            newProps = device.pluginProps
+            newProps['address'] = "Tariff Comparison"
+            device.replacePluginPropsOnServer(newProps)
+        if device.deviceTypeId == "bill_projection":
+            newProps = device.pluginProps
+            newProps['address'] = "Bill Projection"
+            device.replacePluginPropsOnServer(newProps)
         if device.id not in self.deviceList:
-            self.update(device)
+            if device.deviceTypeId == "OctopusEnergy_consumption":
+                # Spread the first update of meters over a minute rather than calling the API for them all at once
+                self.deviceTimers[device.id] = datetime.datetime.now() + datetime.timedelta(seconds=random.uniform(0, 60))
+            else:
+                self.update(device)
             self.deviceList.append(device.id)
 
     ########################################
@@ -128,6 +1054,20 @@ class Plugin(indigo.PluginBase):
         self.debugLog("Stopping device: " + device.name)
         if device.id in self.deviceList:
             self.deviceList.remove(device.id)
+        self.deviceTimers.pop(device.id, None)
+        self.appliancePlans.pop(device.id, None)
+        self.batteryPlans.pop(device.id, None)
+        self.cheapestWindows.pop(device.id, None)
+        self.bandTimelines.pop(device.id, None)
+        if device.deviceTypeId == "load_coordinator":
+            for sensor_id in device.pluginProps.get('charge_sensors', []):
+                self.coordinatedPlans.pop(int(sensor_id), None)
+
+    ########################################
+    def shutdown(self):
+        self.debugLog("Shutting down")
+        # Do not hold up the plugin stopping for requests still in flight
+        self.apiExecutor.shutdown(wait=False)
 
     ########################################
     def runConcurrentThread(self):
@@ -142,13 +1082,38 @@ class Plugin(indigo.PluginBase):
                 # we will check if we have crossed into a new 30 minute period every 30s (so worst case the update could be 30s late)
                 # this is currently configurable (it may be lower as a default the check can be quick without hitting the API so that the rate change happens close to minute 00 and minute 30)
                 # At present the polling frequency will determine the max number of seconds in a given period the tariff could be out of date
-                self.sleep(1 * pollingFreq)
-                for deviceId in self.deviceList:
+                # If a device has a timer due before the next poll then wake up in time for it instead
+                self.sleep(self.secondsToNextUpdate(pollingFreq))
+                now = datetime.datetime.now()
+                self.fireDueEvents(now)
+                self.revalidateCatalog()
+                # Skip devices that have told us they have nothing to do until a later time
+                due = [deviceId for deviceId in self.deviceList
+                       if deviceId not in self.deviceTimers or now >= self.deviceTimers[deviceId]]
+                # Take the devices in turn across API keys so one account with many meters cannot hold up the rest
+                self.apiRound += 1
+                for deviceId in fair_order(due, self.deviceAccount, self.apiRound):
+                    account = self.deviceAccount(deviceId)
+                    if account is not None and self.apiBucket(account).wait_time() > 0 and \
+                            self.deviceCallsApi(indigo.devices[deviceId]):
+                        self.debugLog("Request limit reached, deferring " + indigo.devices[deviceId].name + " to the next cycle")
+                        continue
                     # call the update method with the device instance
                     self.update(indigo.devices[deviceId])
         except self.StopThread:
             pass
 
+    def secondsToNextUpdate(self, pollingFreq):
+        # Sleep for the polling frequency, or less if a device timer or event falls due sooner
+        sleep_seconds = float(pollingFreq)
+        if self.deviceTimers:
+            next_timer = min(self.deviceTimers.values())
+            sleep_seconds = min(sleep_seconds, (next_timer - datetime.datetime.now()).total_seconds())
+        with self.eventLock:
+            if self.eventTimers:
+                sleep_seconds = min(sleep_seconds, (self.eventTimers[0][0] - datetime.datetime.now()).total_seconds())
+        return max(sleep_seconds, 0.1)
+
     ########################################
     def update(self, device):
         ########################################################################
@@ -200,11 +1165,25 @@ class Plugin(indigo.PluginBase):
                 device_states.append({'key': 'Day_Rate', 'value': device.pluginProps['Go_Day_Rate']})
                 device_states.append({'key': 'Go_Rate', 'value': device.pluginProps['Go_Night_Rate']})
                 device_states.append({'key': 'Current_Electricity_Rate', 'value': current_rate})
+                device.updateStatesOnServer(device_states)
 
+            ########################################################################
+            # Go rates only change a couple of times a day, so work out when the next change is due
+            # The concurrent thread will then leave this device alone until that time
+            ########################################################################
 
-
-
-                device.updateStatesOnServer(device_states)
+            next_change, next_is_go = next_go_rate_change(device.pluginProps['Go_Tariff'], now)
+            if next_is_go:
+                next_rate = device.pluginProps['Go_Night_Rate']
+            else:
+                next_rate = device.pluginProps['Go_Day_Rate']
+            device_states = []
+            device_states.append({'key': 'Next_Rate_Change', 'value': next_change.strftime("%Y-%m-%d %H:%M"),
+                                  'uiValue': next_change.strftime("%H:%M")})
+            device_states.append({'key': 'Next_Rate', 'value': next_rate})
+            device.updateStatesOnServer(device_states)
+            self.debugLog("Next Go rate change at " + str(next_change) + " for " + device.name)
+            self.deviceTimers[device.id] = next_change
 
             return
 
@@ -246,6 +1225,13 @@ class Plugin(indigo.PluginBase):
                 self.debugLog("Need to Update Sensor " + current_tariff_valid_period + " Stored " + device.states[
                     "Current_From_Period"] + " for " + device.name)
                 update_sensor = True
+            # If this sensor shares the supply with others, make sure the joint schedule is up to date first
+            coordinator = self.sensorCoordinator(device)
+            if update_sensor and coordinator is not None:
+                self.updateCoordinator(coordinator, current_tariff_valid_period)
+            if update_sensor and device.pluginProps['night_day'] == 'target':
+                self.updateChargePlan(device, tariff_device, current_tariff_valid_period)
+                return
             if update_sensor:
                 device_states = []
                 day_rates = []
@@ -320,6 +1306,12 @@ class Plugin(indigo.PluginBase):
                     preferred_rates.append(str(time_rates[1]))
                     if time_rates[0] == current_tariff_valid_period:
                         sensor_on = True
+                # The load coordinator schedule replaces the sensor's own choice of periods
+                if device.id in self.coordinatedPlans:
+                    coordinated_plan = self.coordinatedPlans[device.id]
+                    preferred_periods = sorted(coordinated_plan)
+                    preferred_rates = [str(coordinated_plan[period]) for period in preferred_periods]
+                    sensor_on = current_tariff_valid_period in coordinated_plan
                 if sensor_on and current_tariff <= float(device.pluginProps['max_rate']):
                     device.updateStateOnServer(key="onOffState", value="on")
                     indigo.server.log("Setting Charge Sensor to ON for " + device.name)
@@ -343,6 +1335,94 @@ class Plugin(indigo.PluginBase):
 
             return
 
+        ########################################################################
+        # Complete the update process for appliance schedulers
+        ########################################################################
+
+        if device.deviceTypeId == "appliance_scheduler":
+            try:
+                tariff_device = indigo.devices[int(device.pluginProps["tariff_device"])]
+            except:
+                self.errorLog(
+                    "No Tariff device associated with the Appliance Scheduler - please select in device settings for " + device.name)
+                return
+            self.updateAppliancePlan(device, tariff_device)
+            return
+
+        ########################################################################
+        # Complete the update process for load coordinators
+        ########################################################################
+
+        if device.deviceTypeId == "load_coordinator":
+            now = datetime.datetime.utcnow()
+            if now.minute > 29:
+                current_period = now.strftime("%Y-%m-%dT%H:30:00Z")
+            else:
+                current_period = now.strftime("%Y-%m-%dT%H:00:00Z")
+            self.updateCoordinator(device, current_period)
+            return
+
+        ########################################################################
+        # Complete the update process for battery optimisers
+        ########################################################################
+
+        if device.deviceTypeId == "battery_optimizer":
+            try:
+                tariff_device = indigo.devices[int(device.pluginProps["tariff_device"])]
+            except:
+                self.errorLog(
+                    "No Tariff device associated with the Battery Optimiser - please select in device settings for " + device.name)
+                return
+            self.updateBatteryPlan(device, tariff_device)
+            return
+
+        ########################################################################
+        # Complete the update process for tariff comparison devices
+        # Only needs to run when the linked consumption device has new data
+        ########################################################################
+
+        if device.deviceTypeId == "OctopusEnergy_comparison":
+            try:
+                consumption_device = indigo.devices[int(device.pluginProps["consumption_device"])]
+            except:
+                self.errorLog(
+                    "No Consumption device associated with the Tariff Comparison - please select in device settings for " + device.name)
+                return
+            if consumption_device.states["API_Today"] == device.states["Last_Compared"]:
+                self.debugLog("No need to update comparison - no new consumption data for " + device.name)
+                return
+            self.compareTariffs(device, consumption_device)
+            return
+
+        ########################################################################
+        # Complete the update process for bill projection devices
+        # Only needs to run when a linked consumption device has new data or the day changes
+        ########################################################################
+
+        if device.deviceTypeId == "bill_projection":
+            try:
+                electricity_device = indigo.devices[int(device.pluginProps["consumption_device"])]
+            except:
+                self.errorLog(
+                    "No Consumption device associated with the Bill Projection - please select in device settings for " + device.name)
+                return
+            gas_device = None
+            if device.pluginProps.get('gas_device', "") not in ("", "none"):
+                try:
+                    gas_device = indigo.devices[int(device.pluginProps["gas_device"])]
+                except:
+                    self.errorLog(
+                        "Gas Consumption device for the Bill Projection no longer exists - please select in device settings for " + device.name)
+                    return
+            projection_key = str(datetime.datetime.now().date()) + " " + electricity_device.states["API_Today"]
+            if gas_device is not None:
+                projection_key = projection_key + " " + gas_device.states["API_Today"]
+            if projection_key == device.states["Last_Projected"]:
+                self.debugLog("No need to update bill projection - no new consumption data for " + device.name)
+                return
+            self.updateBillProjection(device, electricity_device, gas_device, projection_key)
+            return
+
         ########################################################################
         # Complete the update process for consumption devices
         ########################################################################
@@ -359,8 +1439,16 @@ class Plugin(indigo.PluginBase):
 
             if str(local_day) != device.states["API_Today"]:
                 self.debugLog("Need to update consumption - not same day as last update " + device.name)
+                # Each meter starts trying at its own (fixed) time in the first 15 minutes of the day
+                start_time = datetime.datetime.combine(local_day, datetime.time(0)) + datetime.timedelta(
+                    seconds=random.Random(device.id).uniform(0, 900))
+                if datetime.datetime.now() < start_time:
+                    self.deviceTimers[device.id] = start_time
+                    return
             else:
                 self.debugLog("No Need to update consumption - same day as last update " + device.name)
+                self.updateForecast(device)
+                self.updateNetCost(device)
                 return
 
             if device.errorState != "":
@@ -420,18 +1508,14 @@ class Plugin(indigo.PluginBase):
 
                 self.debugLog("Gas " + url)
             #self.debugLog(type(device.pluginProps['API_key']))
-            api_key_concat = device.pluginProps['API_key'] + ":"
-            api_key_bytes = str.encode(api_key_concat)
-            encoded_api_key = base64.b64encode(api_key_bytes)
-            payload = {}
-            headers = {
-                b'Authorization': b'Basic ' + encoded_api_key
-            }
+            # Devices without their own API key use the account key from the plugin config
+            api_key = device.pluginProps['API_key'] or self.pluginPrefs.get('account_api_key', "")
+            headers = self.apiAuthHeaders(api_key)
 
             api_error = False
             # response = requests.request("GET", url, headers=headers, data=payload)
             try:
-                response = requests.get(url, headers=headers, data=payload)
+                response = self.apiGet(url, headers=headers, account=api_key)
                 response.raise_for_status()
             except requests.exceptions.HTTPError as err:
                 self.errorLog("Octopus API refresh failure (Consumption), Http Error " + str(err))
@@ -459,18 +1543,29 @@ class Plugin(indigo.PluginBase):
 
             if not api_error:
                 half_hourly_consumption = response_json['results']
+                # Keep the consumption in the history store so it can be compared against other tariffs
+                new_consumption = dict((slot_key(consumption['interval_start']), consumption['consumption']) for
+                                       consumption in half_hourly_consumption)
+                self.storeHistory(self.consumptionHistoryName(device), new_consumption)
+                device_states.extend(self.consumptionIngested(device, new_consumption))
                 sum_consump = 0
                 consump_state = 0
 
                 if device.pluginProps['calc_costs_yest'] and device.pluginProps['meter_type'] == 'electricity':
                     tariff_device = indigo.devices[int(device.pluginProps["tariff_device"])]
                     yesterday_rates = json.loads(tariff_device.pluginProps['yesterday_rates'])
+                    # Use the rate of the tariff agreement active in each period where the account is known
+                    slot_rates = self.consumptionRates(device, list(new_consumption))
 
                 for consumption in reversed(half_hourly_consumption):
                     if device.pluginProps['calc_costs_yest'] and device.pluginProps['meter_type'] == 'electricity':
 
-                        half_hour_cost = consumption["consumption"] * yesterday_rates[(47 - consump_state)][
-                            'value_inc_vat']
+                        consumption_key = slot_key(consumption['interval_start'])
+                        if consumption_key in slot_rates:
+                            half_hour_cost = consumption["consumption"] * slot_rates[consumption_key]
+                        else:
+                            half_hour_cost = consumption["consumption"] * yesterday_rates[(47 - consump_state)][
+                                'value_inc_vat']
                         if dst_applies:
                             device_states.append(
                                 {'key': state_list[consump_state], 'value': half_hour_cost, 'decimalPlaces': 4})
@@ -529,6 +1624,9 @@ class Plugin(indigo.PluginBase):
             device.updateStatesOnServer(device_states)
             if api_error:
                 device.setErrorStateOnServer('Meter Data Not Yet Available')
+                # Retry in 30 minutes, plus up to 5 minutes so meters that failed together do not retry together
+                self.deviceTimers[device.id] = datetime.datetime.now() + datetime.timedelta(
+                    minutes=30, seconds=random.uniform(0, 300))
             ########################################################################
             # Consumption device updates complete
             ########################################################################
@@ -541,10 +1639,13 @@ class Plugin(indigo.PluginBase):
 
         device.stateListOrDisplayStateIdChanged()
 
-        # The Tariff code is built from the Grid Supply Point (gsp) and the product code.  For the purposes of the plugin this is hardcoded to the agile offering
-        # No need to vary this for the current version, but I will review in the future as it may be other tariffs than Agile may be of interest (even if they do not change every 30 mins)
-        TARIFF_CODE = "E-1R-" + PRODUCT_CODE + "-" + device.pluginProps['device_gsp']
-        GET_STANDING_CHARGES = BASE_URL + "/products/" + PRODUCT_CODE + "/electricity-tariffs/" + TARIFF_CODE + "/standing-charges/"
+        # The Tariff code is built from the Grid Supply Point (gsp) and the product code.  This is the Agile offering,
+        # or Agile Outgoing for export rate devices which share this update
+        # The codes only change at the first update of the day, so a day's rates are always under one tariff
+        if device.states["API_Today"] != str(datetime.datetime.now().date()):
+            self.pinTariff(device)
+        product_code = self.productCode(device)
+        TARIFF_CODE = self.tariffCode(device)
         # Due to the way they API publishes the daily rates, I will force a refresh at 17:00 utc, as not all of the rates would have been available at midnight the previous day)
 
         ########################################################################
@@ -637,40 +1738,46 @@ class Plugin(indigo.PluginBase):
 
                 indigo.server.log("Refreshing Daily Rate Information from the Octopus API for Device " + device.name)
 
-                PERIOD = "period_from=" + str(local_day) + "T00:00&period_to=" + str(local_day) + "T23:59"
-
-                GET_LOCAL_TARIFFS = BASE_URL + "/products/" + PRODUCT_CODE + "/electricity-tariffs/" + TARIFF_CODE + "/standard-unit-rates/?" + PERIOD
+                # One request covers the local days from yesterday to tomorrow (so DST changes are handled), and
+                # starts from the first rate not already in the rate store so repeat refreshes only get new rates
+                # Tomorrow's rates are published from around 16:00 and extend the horizon used to plan charging
+                local_tomorrow = local_day + datetime.timedelta(days=1)
+                range_keys = local_day_keys(local_yesterday) + local_day_keys(local_day) + local_day_keys(local_tomorrow)
                 try:
-                    response = requests.get(GET_LOCAL_TARIFFS, timeout=float(self.pluginPrefs['requeststimeout']))
-                    response.raise_for_status()
-                except requests.exceptions.HTTPError as err:
-                    self.errorLog("Octopus API refresh failure, Http Error " + str(err))
-                    device_states.append({'key': 'API_Today', 'value': "API Refresh Failed"})
-                    device.setErrorStateOnServer("No Update")
-                    api_error = True
+                    self.refreshRateRange(product_code, TARIFF_CODE, range_keys)
                 except Exception as err:
-                    self.errorLog("Octopus API refresh failure, Other error " + str(err))
+                    self.errorLog("Octopus API refresh failure, " + str(err))
                     device_states.append({'key': 'API_Today', 'value': "API Refresh Failed"})
                     device.setErrorStateOnServer("No Update")
                     api_error = True
-                # If API request succeeded, then save the response, and update the "API_Today" device state
-                try:
-                    if response.status_code == 200:
-                        results_json = response.json()
-                        # self.debugLog(results_json)
-                        half_hourly_rates = results_json['results']
-                        # Update the device state to show the API update has run sucessfully
-                        device_states.append({'key': 'API_Today', 'value': str(local_day)})
-                        self.debugLog("Got the rates OK")
-                        self.debugLog(half_hourly_rates)
-                        if current_tariff_valid_period == str(local_day) + "T17:00:00Z":
-                            self.debugLog("Setting Afternoon refresh done to device state")
-                            device_states.append({'key': 'API_Afternoon_Refresh', 'value': True})
-                # Catch all other possible failures
-                except:
-                    self.errorLog("Octopus API Refresh, Error in getting current tariffs")
-                    device_states.append({'key': 'API_Today', 'value': "API Refresh Failed"})
-                    device.setErrorStateOnServer("No Update")
+
+                # Split the store back into today's and yesterday's rates, in the same form as the API results
+                # If the API could not be reached, carry on with today's rates from the rate store (normally fetched
+                # the afternoon before) flagged as stale, and keep trying the API in the background
+                # API_Today is left as failed so the next half hour also tries the API
+                half_hourly_rates = self.storedDayRates(TARIFF_CODE, local_day, current_tariff_valid_period)
+                results_json = {'count': len(half_hourly_rates)}
+                stale_rates = False
+                if not half_hourly_rates:
+                    if not api_error:
+                        self.errorLog("Octopus API Refresh, Error in getting current tariffs")
+                        device_states.append({'key': 'API_Today', 'value': "API Refresh Failed"})
+                        device.setErrorStateOnServer("No Update")
+                    api_error = True
+                elif api_error:
+                    indigo.server.log("Using stored rates for " + device.name + " until the Octopus API responds")
+                    api_error = False
+                    stale_rates = True
+                    self.revalidateRates(device, product_code, TARIFF_CODE, range_keys)
+                else:
+                    # Update the device state to show the API update has run sucessfully
+                    device_states.append({'key': 'API_Today', 'value': str(local_day)})
+                    self.debugLog("Got the rates OK")
+                    self.debugLog(half_hourly_rates)
+                    if current_tariff_valid_period == str(local_day) + "T17:00:00Z":
+                        self.debugLog("Setting Afternoon refresh done to device state")
+                        device_states.append({'key': 'API_Afternoon_Refresh', 'value': True})
+                device_states.append({'key': 'Rates_Stale', 'value': stale_rates})
 
                 ########################################################################
                 # Iterate through the rate retured and calculate the
@@ -744,13 +1851,16 @@ class Plugin(indigo.PluginBase):
 
                         # output a list for cheapest 30m, 1h, 2h. 3h and 4h
                     self.debugLog(json.dumps([output[0], output[1], output[3], output[5], output[7]]))
+                    self.cheapestWindows[device.id] = dict(
+                        (x + 1, datetime.datetime.strptime(output[x]['time'], "%m/%d/%Y, %H:%M:%S")) for x in (0, 1, 3, 5, 7))
 
                     # Update the states to be applied to the server for the todays rates if the API call succeeded
 
                     device_states.append({'key': 'Daily_Average_Rate', 'value': average_rate, 'decimalPlaces': 4})
                     device_states.append({'key': 'Daily_Max_Rate', 'value': max_rate, 'decimalPlaces': 4})
                     device_states.append({'key': 'Daily_Min_Rate', 'value': min_rate, 'decimalPlaces': 4})
-                    device_states.append({'key': 'API_Today', 'value': str(local_day)})
+                    if not stale_rates:
+                        device_states.append({'key': 'API_Today', 'value': str(local_day)})
                     device_states.append({'key': 'lowest_30m_cost', 'value': output[0]['cost'], 'decimalPlaces': 4})
                     device_states.append({'key': 'lowest_30m_time', 'value': str(output[0]['time']),
                                           'uiValue': str(output[0]['uiTime'])})
@@ -775,38 +1885,14 @@ class Plugin(indigo.PluginBase):
                     updatedProps['today_rates'] = json.dumps(half_hourly_rates)
 
                 ########################################################################
-                # Get Yesterdays Rates from the API (rather than copying yesterdays)
+                # Yesterdays Rates come from the same range request (rather than copying yesterdays)
                 # This is more robust and will provide yesterdays data on the first device update
                 # Also it does not matter if this is run at a different time as it is now
                 # Does not over-write but recalculates correctly
                 ########################################################################
 
-                YESTERDAY_PERIOD = "period_from=" + str(local_yesterday) + "T00:00&period_to=" + str(
-                    local_yesterday) + "T23:59"
-                GET_YESTERDAY_TARIFFS = BASE_URL + "/products/" + PRODUCT_CODE + "/electricity-tariffs/" + TARIFF_CODE + "/standard-unit-rates/?" + YESTERDAY_PERIOD
-
-                try:
-                    yesterday_response = requests.get(GET_YESTERDAY_TARIFFS,
-                                                      timeout=float(self.pluginPrefs['requeststimeout']))
-                    yesterday_response.raise_for_status()
-                except requests.exceptions.HTTPError as err:
-                    self.errorLog("Octopus API refresh failure (Yesterday refresh), Http Error " + str(err))
-                    api_error_yest = True
-                except Exception as err:
-                    self.errorLog("Octopus API refresh failure (Yesterday refresh), Other error " + str(err))
-                    api_error_yest = True
-                # If API request succeeded, then save the response, and update the "API_Today" device state
-                try:
-                    if yesterday_response.status_code == 200:
-                        yesterday_results_json = yesterday_response.json()
-                        # self.debugLog(results_json)
-                        yesterday_half_hourly_rates = yesterday_results_json['results']
-                        # If this is the 17:00Z run then update the device state to show it has been completed
-                        if update_afternoon_refresh:
-                            self.debugLog("Setting Afternoon refresh done to device state")
-                            device_states.append({'key': 'API_Afternoon_Refresh', 'value': True})
-                # Catch all other possible failures
-                except:
+                yesterday_half_hourly_rates = self.storedDayRates(TARIFF_CODE, local_yesterday, None)
+                if not yesterday_half_hourly_rates:
                     self.errorLog("Octopus API Refresh, Error in getting yesterday tariffs")
                     api_error_yest = True
 
@@ -827,7 +1913,7 @@ class Plugin(indigo.PluginBase):
                             max_rate_yest = rates["value_inc_vat"]
                         if float(rates["value_inc_vat"]) <= float(min_rate_yest):
                             min_rate_yest = rates["value_inc_vat"]
-                    average_rate_yest = sum_rates_yest / yesterday_results_json['count']
+                    average_rate_yest = sum_rates_yest / len(yesterday_half_hourly_rates)
 
                 ########################################################################
                 # Store the JSON response to the device so that the API doesn't need to be called every 30 mins
@@ -838,9 +1924,6 @@ class Plugin(indigo.PluginBase):
 
                 if not api_error and not api_error_yest:
                     device.replacePluginPropsOnServer(updatedProps)
-                    device_states.append(
-                        {'key': 'Yesterday_Standing_Charge', 'value': device.states['Daily_Standing_Charge'],
-                         'uiValue': str(device.states['Daily_Standing_Charge']) + "p"})
                     device_states.append(
                         {'key': 'Yesterday_Average_Rate', 'value': average_rate_yest, 'decimalPlaces': 4})
                     device_states.append({'key': 'Yesterday_Max_Rate', 'value': max_rate_yest, 'decimalPlaces': 4})
@@ -850,26 +1933,35 @@ class Plugin(indigo.PluginBase):
                     self.debugLog("Resetting Afternoon Refresh to False")
                 self.debugLog("Updating yesterday rates")
 
+                self.debugLog("Holding " + str(len(self.storedDayRates(TARIFF_CODE, local_tomorrow, None))) +
+                              " rates for tomorrow")
+
+                # New rates mean the times for any rate events need to be worked out again
+                self.scheduleRateEvents(device)
+                self.scheduleWindowEvents(device)
+                self.bandTimelines.pop(device.id, None)
+
                 ########################################################################
                 # Update the standing charge
-                # Unlikely to change too often but the overhead is small so twice daily updates not excessive
+                # Charges are cached with the dates they apply between, so the API is only asked again
+                # when the current charge expires, and today's and yesterday's charges are looked up by day
                 ########################################################################
 
-                try:
-                    response = requests.get(GET_STANDING_CHARGES, timeout=float(self.pluginPrefs['requeststimeout']))
-                    response.raise_for_status()
-                except requests.exceptions.HTTPError as err:
-                    self.errorLog("Octopus API - Standing Charge Http Error " + str(err))
-                except Exception as err:
-                    self.errorLog("Octopus API - Standing Charge Other error" + str(err))
-                try:
-                    if response.status_code == 200:
-                        standing_charge_json = response.json()
-                        standing_charge_inc_vat = float(standing_charge_json["results"][0]["value_inc_vat"])
-                        device_states.append({'key': 'Daily_Standing_Charge', 'value': standing_charge_inc_vat,
-                                              'uiValue': str(standing_charge_inc_vat) + "p"})
-                        self.debugLog("Standing Charge " + str(standing_charge_inc_vat))
-                except:
+                standing_charges = self.standingCharges(product_code, TARIFF_CODE)
+                standing_charge_inc_vat = standing_charge_on(standing_charges, local_day_keys(local_day)[0][1])
+                if standing_charge_inc_vat is not None:
+                    device_states.append({'key': 'Daily_Standing_Charge', 'value': standing_charge_inc_vat,
+                                          'uiValue': str(standing_charge_inc_vat) + "p"})
+                    self.debugLog("Standing Charge " + str(standing_charge_inc_vat))
+                    # If the charges held do not reach back to yesterday (e.g. a new device) then apply todays charge
+                    # as this is better than it appearing as zero
+                    yesterday_standing_charge = standing_charge_on(standing_charges,
+                                                                   local_day_keys(local_yesterday)[0][1])
+                    if yesterday_standing_charge is None:
+                        yesterday_standing_charge = standing_charge_inc_vat
+                    device_states.append({'key': 'Yesterday_Standing_Charge', 'value': yesterday_standing_charge,
+                                          'uiValue': str(yesterday_standing_charge) + "p"})
+                else:
                     self.errorLog("Octopus API - Standing Charge Error getting Standing Charges")
                     device_states.append({'key': 'Daily_Standing_Charge', 'value': 0,
                                           'uiValue': "Error Standing Charge"})
@@ -880,14 +1972,6 @@ class Plugin(indigo.PluginBase):
                 # device_states.append({ 'key': 'Daily_Standing_Charge', 'value' : standing_charge_inc_vat , 'uiValue' :str(standing_charge_inc_vat)+"p" })
                 device.updateStateImageOnServer(indigo.kStateImageSel.EnergyMeterOn)
 
-                # If this is the first update the yesterday standing charge will be set to zero, this applies todays rate to yesterday
-                # as this is better than it appearing as zero.  risk that if the rate changed the day before you created the device the update will be 1 day late
-                # but this unlikely risk is better than it appearing to be zero
-
-                if device.states["Yesterday_Standing_Charge"] == 0:
-                    device_states.append({'key': 'Yesterday_Standing_Charge', 'value': standing_charge_inc_vat,
-                                          'uiValue': str(standing_charge_inc_vat) + "p"})
-
                 ########################################################################
                 # This ends the indented section that only runs
                 # if it is 00:00 or 17:00Z
@@ -937,6 +2021,7 @@ class Plugin(indigo.PluginBase):
                 device_states.append({'key': 'Current_Electricity_Rate', 'value': current_tariff, 'decimalPlaces': 4,
                                       'uiValue': str(current_tariff) + "p", 'clearErrorState': True})
                 device_states.append({'key': 'Current_From_Period', 'value': current_tariff_valid_period})
+                device_states.extend(self.priceBandStates(device, current_tariff_valid_period))
             else:
                 self.debugLog("No current rate found for " + device.name + " will correct when API responds")
                 device.setErrorStateOnServer('Rate information not available - possible API error')
@@ -958,6 +2043,1482 @@ class Plugin(indigo.PluginBase):
         self.debugLog("Update cycle complete for " + device.name)
         return ()
 
+    ########################################
+    # Octopus API Client
+    ########################################
+
+    # All API requests go through one session so connections are reused, and a successful response is kept
+    # for a few minutes so devices asking for the same URL (e.g. import and export on one GSP) only fetch it once
+
+    def apiAuthHeaders(self, api_key):
+        api_key_concat = api_key + ":"
+        api_key_bytes = str.encode(api_key_concat)
+        encoded_api_key = base64.b64encode(api_key_bytes)
+        return {
+            b'Authorization': b'Basic ' + encoded_api_key
+        }
+
+    def apiBucket(self, account):
+        with self.apiLock:
+            if account not in self.apiBuckets:
+                per_minute = float(self.pluginPrefs.get('apiRateLimit', 60))
+                self.apiBuckets[account] = TokenBucket(per_minute / 60, 5)
+            return self.apiBuckets[account]
+
+    def deviceAccount(self, deviceId):
+        # The API key a device's requests are limited under, "public" for rate devices, None if it makes no requests
+        device = indigo.devices[deviceId]
+        if device.deviceTypeId == "OctopusEnergy_consumption":
+            return device.pluginProps['API_key'] or self.pluginPrefs.get('account_api_key', "")
+        if device.deviceTypeId in ("OctopusEnergy", "OctopusEnergyExport"):
+            return "public"
+        return None
+
+    def deviceCallsApi(self, device):
+        # Whether this update of an API device will make requests, rate devices only do for the daily and 17:00Z
+        # refreshes and consumption meters until the day's readings are in, otherwise they use stored data
+        local_day = datetime.datetime.now().date()
+        if device.states["API_Today"] != str(local_day):
+            return True
+        if device.deviceTypeId in ("OctopusEnergy", "OctopusEnergyExport"):
+            now = datetime.datetime.utcnow()
+            afternoon_period = str(local_day) + "T17:00:00Z"
+            return now.minute < 30 and now.strftime("%Y-%m-%dT%H:00:00Z") == afternoon_period and \
+                device.states["Current_From_Period"] != afternoon_period and device.states['API_Afternoon_Refresh'] == False
+        return False
+
+    def apiBreaker(self, endpoint):
+        with self.apiLock:
+            if endpoint not in self.apiBreakers:
+                self.apiBreakers[endpoint] = CircuitBreaker(API_CIRCUIT_THRESHOLD, API_CIRCUIT_COOLDOWN)
+            return self.apiBreakers[endpoint]
+
+    def publishApiHealth(self, endpoint):
+        # Circuit state and retry count for each endpoint are kept in Indigo variables for triggers and control pages
+        breaker = self.apiBreaker(endpoint)
+        latency = self.apiLatency(endpoint)
+        health = (breaker.state(), breaker.retries, latency.quantile(0.5), latency.quantile(0.99))
+        with self.apiLock:
+            if self.apiHealth.get(endpoint) == health:
+                return
+            self.apiHealth[endpoint] = health
+        try:
+            if API_HEALTH_FOLDER not in indigo.variables.folders:
+                indigo.variables.folder.create(API_HEALTH_FOLDER)
+            folder_id = indigo.variables.folders[API_HEALTH_FOLDER].id
+            values = [("Octopus_API_" + endpoint + "_Circuit", health[0]),
+                      ("Octopus_API_" + endpoint + "_Retries", str(health[1]))]
+            # Latency percentiles in milliseconds, once there are enough responses
+            if health[2] is not None:
+                values.append(("Octopus_API_" + endpoint + "_p50", str(int(health[2] * 1000))))
+                values.append(("Octopus_API_" + endpoint + "_p99", str(int(health[3] * 1000))))
+            for name, value in values:
+                if name in indigo.variables:
+                    indigo.variable.updateValue(name, value=value)
+                else:
+                    indigo.variable.create(name, value=value, folder=folder_id)
+        except Exception as err:
+            self.debugLog("Unable to update API health variables " + str(err))
+
+    def apiLatency(self, endpoint):
+        with self.apiLock:
+            if endpoint not in self.apiLatencies:
+                self.apiLatencies[endpoint] = LatencyWindow(API_LATENCY_WINDOW, API_LATENCY_MIN_SAMPLES)
+            return self.apiLatencies[endpoint]
+
+    def apiRequest(self, endpoint, url, headers, bucket):
+        # Send the request with a timeout set from the endpoint's response times, and if it has not answered by
+        # the 95th percentile send a duplicate (if the request limit allows) and use whichever answers first
+        latency = self.apiLatency(endpoint)
+        timeout = latency.timeout(float(self.pluginPrefs['requeststimeout']))
+        hedge_after = latency.quantile(0.95)
+        started = time.time()
+        requests_sent = [self.apiExecutor.submit(self.apiSession.get, url, headers=headers, timeout=timeout)]
+        # Stop waiting once the last request sent has had its whole timeout
+        deadline = started + timeout
+        if hedge_after is not None:
+            done, not_done = concurrent.futures.wait(requests_sent, timeout=hedge_after)
+            if not done and bucket.wait_time() == 0:
+                bucket.take()
+                self.debugLog("Octopus API " + endpoint + " slow to respond, sending a second request")
+                requests_sent.append(
+                    self.apiExecutor.submit(self.apiSession.get, url, headers=headers, timeout=timeout))
+                deadline = time.time() + timeout
+        error = None
+        try:
+            for request_sent in concurrent.futures.as_completed(requests_sent, timeout=max(0, deadline - time.time())):
+                try:
+                    response = request_sent.result()
+                except Exception as err:
+                    error = err
+                    continue
+                latency.add(time.time() - started)
+                return response
+        except concurrent.futures.TimeoutError:
+            error = requests.exceptions.Timeout("Octopus API " + endpoint + " did not respond within " +
+                                                str(round(timeout, 1)) + "s")
+        # A timeout counts as taking the whole timeout, so the next request is given longer
+        if isinstance(error, requests.exceptions.Timeout):
+            latency.add(timeout)
+        raise error
+
+    def apiGet(self, url, headers=None, max_age=300, account="public"):
+        cache_key = url + str(headers)
+        with self.apiLock:
+            cached = self.apiCache.get(cache_key)
+        if cached is not None and cached[0] > time.time():
+            self.debugLog("Using cached response for " + url)
+            return cached[1]
+        endpoint = api_endpoint(url)
+        breaker = self.apiBreaker(endpoint)
+        if not breaker.allow():
+            raise requests.exceptions.ConnectionError(
+                "Octopus API " + endpoint + " requests suspended after repeated failures")
+        retry = 0
+        while True:
+            # Wait for the account's request limit, the update cycle defers devices so this is normally immediate
+            bucket = self.apiBucket(account)
+            self.sleep(bucket.wait_time())
+            bucket.take()
+            error = None
+            try:
+                response = self.apiRequest(endpoint, url, headers, bucket)
+                # Other 4xx responses will not succeed if repeated, and show the API itself is working
+                transient = response.status_code == 429 or response.status_code >= 500
+            except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as err:
+                transient = True
+                error = err
+            except Exception:
+                # Any other failure still counts against the endpoint, and resolves a half-open trial request
+                breaker.failure()
+                self.publishApiHealth(endpoint)
+                raise
+            if not transient or retry >= API_RETRIES:
+                break
+            retry += 1
+            breaker.retries += 1
+            delay = random.uniform(0, min(API_BACKOFF_CAP, API_BACKOFF_BASE * 2 ** retry))
+            self.debugLog("Octopus API " + endpoint + " request failed, retry " + str(retry) + " in " +
+                          str(round(delay, 1)) + "s")
+            self.sleep(delay)
+        if transient:
+            breaker.failure()
+            if breaker.state() == "open":
+                self.errorLog("Octopus API " + endpoint + " requests suspended for " +
+                              str(API_CIRCUIT_COOLDOWN // 60) + " minutes after repeated failures")
+        else:
+            breaker.success()
+        self.publishApiHealth(endpoint)
+        if error is not None:
+            raise error
+        if response.status_code == 200:
+            with self.apiLock:
+                for expired_key in [key for key, value in self.apiCache.items() if value[0] <= time.time()]:
+                    del self.apiCache[expired_key]
+                self.apiCache[cache_key] = (time.time() + max_age, response)
+        return response
+
+    ########################################
+    # Account Discovery
+    ########################################
+
+    def accountDetails(self, refresh=False):
+        # The account (properties, meter points, serials and tariff agreements) is fetched when discovery is run
+        # from the menu and kept in the plugin preferences folder, everything else uses the cached copy
+        account_number = self.pluginPrefs.get('account_number', "")
+        if account_number == "":
+            return {}
+        name = "account-" + account_number
+        if refresh:
+            response = self.apiGet(BASE_URL + "/accounts/" + account_number + "/",
+                                   headers=self.apiAuthHeaders(self.pluginPrefs.get('account_api_key', "")),
+                                   account=self.pluginPrefs.get('account_api_key', ""))
+            response.raise_for_status()
+            self.storeHistory(name, {'properties': response.json()['properties'],
+                                     'fetched': datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")})
+        return self.loadHistory(name)
+
+    def accountMeters(self, account):
+        # Flatten the account into (meter type, meter point, serial, export, agreements, address) for each meter
+        meters = []
+        for account_property in account.get('properties', []):
+            if account_property.get('moved_out_at'):
+                continue
+            address = account_property.get('address_line_1', "") + " " + account_property.get('postcode', "")
+            for meter_point in account_property.get('electricity_meter_points', []):
+                for meter in meter_point.get('meters', []):
+                    meters.append(('electricity', meter_point['mpan'], meter['serial_number'],
+                                   meter_point.get('is_export', False), meter_point.get('agreements', []), address.strip()))
+            for meter_point in account_property.get('gas_meter_points', []):
+                for meter in meter_point.get('meters', []):
+                    meters.append(('gas', meter_point['mprn'], meter['serial_number'], False,
+                                   meter_point.get('agreements', []), address.strip()))
+        return meters
+
+    def discoverAccount(self):
+        try:
+            account = self.accountDetails(refresh=True)
+        except Exception as err:
+            self.errorLog("Octopus API - Unable to get the account details " + str(err))
+            return
+        if not account:
+            self.errorLog("Enter the account number and API key in the plugin config to discover meters")
+            return
+        existing = {}
+        for dev in indigo.devices.iter("self"):
+            if dev.deviceTypeId == 'OctopusEnergy_consumption':
+                existing.setdefault(dev.pluginProps['meter_point'], []).append(dev)
+        rate_devices = {'import': None, 'export': None}
+        for dev in indigo.devices.iter("self"):
+            if dev.deviceTypeId == 'OctopusEnergy' and rate_devices['import'] is None:
+                rate_devices['import'] = dev.id
+            if dev.deviceTypeId == 'OctopusEnergyExport' and rate_devices['export'] is None:
+                rate_devices['export'] = dev.id
+        now_key = datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+        for meter_type, meter_point, serial, is_export, agreements, address in self.accountMeters(account):
+            current_tariff = "None"
+            for agreement in agreements:
+                if slot_key(agreement['valid_from']) <= now_key and (
+                        not agreement.get('valid_to') or slot_key(agreement['valid_to']) > now_key):
+                    current_tariff = agreement['tariff_code']
+            indigo.server.log("Found " + meter_type + " meter " + meter_point + " serial " + serial + " at " + address +
+                              " on tariff " + current_tariff)
+            if meter_point in existing:
+                # Validate the devices already set up for this meter point
+                for dev in existing[meter_point]:
+                    if dev.pluginProps['meter_serial'] != serial:
+                        self.errorLog(dev.name + " has serial " + dev.pluginProps['meter_serial'] + " but the account has " + serial + " for " + meter_point)
+                    elif dev.pluginProps['meter_type'] != meter_type:
+                        self.errorLog(dev.name + " is set as a " + dev.pluginProps['meter_type'] + " meter but " + meter_point + " is " + meter_type)
+                    else:
+                        indigo.server.log(dev.name + " matches the account")
+                continue
+            if not self.pluginPrefs.get('account_create_devices', False):
+                continue
+            props = {'API_key': "", 'meter_type': meter_type, 'meter_point': meter_point, 'meter_serial': serial,
+                     'export_meter': is_export, 'meter_type_SMETS2': True, 'Log_Rates': False,
+                     'calc_costs_yest': False, 'tariff_device': "", 'import_device': "none", 'anomaly_threshold': "5"}
+            # Cost Agile meters against the matching rate device if there is one
+            rate_device = rate_devices['export' if is_export else 'import']
+            if meter_type == 'electricity' and "AGILE" in current_tariff and rate_device is not None:
+                props['calc_costs_yest'] = True
+                props['tariff_device'] = str(rate_device)
+            if is_export:
+                name = "Octopus Export " + meter_point
+            else:
+                name = "Octopus " + meter_type.capitalize() + " " + meter_point
+            try:
+                indigo.device.create(protocol=indigo.kProtocol.Plugin, name=name, address=address,
+                                     pluginId=self.pluginId, deviceTypeId="OctopusEnergy_consumption", props=props)
+                indigo.server.log("Created " + name)
+            except Exception as err:
+                self.errorLog("Unable to create a device for " + meter_point + " " + str(err))
+
+    ########################################
+    # Product Catalog
+    ########################################
+
+    def revalidateCatalog(self):
+        # Refresh the catalog once a day in the background, the devices keep using the cached copy meanwhile
+        fetched = self.loadHistory("products").get('fetched', "")
+        if fetched > (datetime.datetime.utcnow() - datetime.timedelta(days=1)).strftime("%Y-%m-%dT%H:%M:%SZ"):
+            return
+        if self.catalogThread is not None and self.catalogThread.is_alive():
+            return
+        # If the last attempt failed, wait an hour before trying again
+        if self.catalogAttempted is not None and time.time() - self.catalogAttempted < 3600:
+            return
+        self.catalogAttempted = time.time()
+        self.catalogThread = threading.Thread(target=self.fetchCatalog, name="Octopus product catalog")
+        self.catalogThread.daemon = True
+        self.catalogThread.start()
+
+    def fetchCatalog(self):
+        try:
+            products = []
+            url = BASE_URL + "/products/?brand=OCTOPUS_ENERGY&is_business=false"
+            while url:
+                response = self.apiGet(url)
+                response.raise_for_status()
+                results_json = response.json()
+                products.extend(results_json['results'])
+                url = results_json.get('next')
+            catalog = index_products(products)
+            # Only the current product in each family used by the plugin needs its regional tariff codes
+            now_key = datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+            for family, direction, fallback in PRODUCT_FAMILIES.values():
+                product_code = current_product(catalog, family, direction, now_key)
+                if product_code is None:
+                    continue
+                response = self.apiGet(BASE_URL + "/products/" + product_code + "/")
+                response.raise_for_status()
+                for region, payments in response.json().get('single_register_electricity_tariffs', {}).items():
+                    for payment in payments.values():
+                        catalog['products'][product_code]['regions'][region.lstrip("_")] = payment['code']
+                        break
+            catalog['fetched'] = now_key
+            self.storeHistory("products", catalog)
+            self.debugLog("Product catalog refreshed with " + str(len(products)) + " products")
+        except Exception as err:
+            self.errorLog("Octopus API - Unable to refresh the product catalog " + str(err))
+
+    def storedDayRates(self, tariff_code, day, current_period):
+        # The day's rates from the rate store in the same form as the API results (latest first), as long as
+        # they run unbroken from the start of the day up to at least the current period
+        stored = self.loadHistory("rates-" + tariff_code)
+        day_rates = []
+        for slot, key in local_day_keys(day):
+            if key not in stored:
+                break
+            day_rates.append({'valid_from': key, 'value_inc_vat': stored[key]})
+        if current_period is not None and current_period not in [rates['valid_from'] for rates in day_rates]:
+            return []
+        return list(reversed(day_rates))
+
+    def refreshRateRange(self, product_code, tariff_code, range_keys):
+        # Fetch the rates from the first slot missing from the rate store to the end of the range in one request
+        # (following any further pages) into the store.  Nothing is requested if the store already has them all
+        stored = self.loadHistory("rates-" + tariff_code)
+        missing = [key for slot, key in range_keys if key not in stored]
+        if not missing:
+            self.debugLog("All rates for " + tariff_code + " already held, no API request needed")
+            return
+        range_end = datetime.datetime.strptime(range_keys[-1][1], "%Y-%m-%dT%H:%M:%SZ") + datetime.timedelta(minutes=30)
+        url = BASE_URL + "/products/" + product_code + "/electricity-tariffs/" + tariff_code + \
+            "/standard-unit-rates/?period_from=" + missing[0] + "&period_to=" + \
+            range_end.strftime("%Y-%m-%dT%H:%M:%SZ") + "&page_size=1500"
+        rates = {}
+        while url:
+            response = self.apiGet(url)
+            response.raise_for_status()
+            results_json = response.json()
+            for result in results_json['results']:
+                rates[slot_key(result['valid_from'])] = result['value_inc_vat']
+            url = results_json.get('next')
+        self.storeHistory("rates-" + tariff_code, rates)
+        self.debugLog("Got " + str(len(rates)) + " rates for " + tariff_code + " from " + missing[0])
+
+    def standingCharges(self, product_code, tariff_code):
+        # The standing charges for the tariff with their validity windows, from the store until the charge in effect
+        # now expires (or for an open ended charge, STANDING_CHARGE_RECHECK_DAYS after it was fetched)
+        name = "standing-" + tariff_code
+        cached = self.loadHistory(name)
+        now = datetime.datetime.utcnow()
+        now_key = now.strftime("%Y-%m-%dT%H:%M:%SZ")
+        if now_key < cached.get('expires', ""):
+            return cached['charges']
+        charges = []
+        url = BASE_URL + "/products/" + product_code + "/electricity-tariffs/" + tariff_code + "/standing-charges/"
+        try:
+            while url:
+                response = self.apiGet(url)
+                response.raise_for_status()
+                results_json = response.json()
+                for result in results_json['results']:
+                    # The same window is listed for each payment method, the direct debit charge is used
+                    if result.get('payment_method') == "NON_DIRECT_DEBIT":
+                        continue
+                    charges.append({'valid_from': slot_key(result['valid_from']) if result.get('valid_from') else "",
+                                    'valid_to': slot_key(result['valid_to']) if result.get('valid_to') else None,
+                                    'value_inc_vat': float(result['value_inc_vat'])})
+                url = results_json.get('next')
+        except Exception as err:
+            self.errorLog("Octopus API - Standing Charge error " + str(err))
+            return cached.get('charges', [])
+        expires = (now + datetime.timedelta(days=STANDING_CHARGE_RECHECK_DAYS)).strftime("%Y-%m-%dT%H:%M:%SZ")
+        for charge in charges:
+            if charge['valid_from'] <= now_key and charge['valid_to'] is not None and now_key < charge['valid_to']:
+                expires = charge['valid_to']
+        self.storeHistory(name, {'charges': charges, 'expires': expires})
+        self.debugLog("Got " + str(len(charges)) + " standing charges for " + tariff_code + " valid until " + expires)
+        return charges
+
+    def standingChargeDays(self, tariff_device):
+        # The stored charges by local day, and the current charge for days they do not cover
+        charges = self.loadHistory("standing-" + self.tariffCode(tariff_device)).get('charges', [])
+        return standing_charge_days(charges), float(tariff_device.states['Daily_Standing_Charge'])
+
+    def standingChargeLookup(self, tariff_device):
+        # Returns the daily standing charge for a local day (as a string)
+        charge_days, current_charge = self.standingChargeDays(tariff_device)
+
+        def standing_charge(day):
+            ordinal = datetime.datetime.strptime(day, "%Y-%m-%d").date().toordinal()
+            return standing_charge_total(charge_days, current_charge, ordinal, ordinal + 1)
+
+        return standing_charge
+
+    def revalidateRates(self, device, product_code, tariff_code, range_keys):
+        thread = self.rateThreads.get(device.id)
+        if thread is not None and thread.is_alive():
+            return
+        thread = threading.Thread(target=self.fetchRatesInBackground,
+                                  args=(device.id, product_code, tariff_code, range_keys),
+                                  name="Octopus rates " + device.name)
+        thread.daemon = True
+        self.rateThreads[device.id] = thread
+        thread.start()
+
+    def fetchRatesInBackground(self, deviceId, product_code, tariff_code, range_keys):
+        # Try the API every few minutes until it responds, then clear the current period so the next update cycle
+        # refreshes the device (from the rate store).  Stops if the device is stopped or the day changes
+        day = datetime.datetime.now().date()
+        while deviceId in self.deviceList and datetime.datetime.now().date() == day:
+            time.sleep(RATES_REVALIDATE_INTERVAL + random.uniform(0, 60))
+            try:
+                self.refreshRateRange(product_code, tariff_code, range_keys)
+            except Exception as err:
+                self.debugLog("Background rate refresh failed, " + str(err))
+                continue
+            if deviceId in self.deviceList:
+                indigo.server.log("Octopus API responding again, refreshing rates for " + indigo.devices[deviceId].name)
+                indigo.devices[deviceId].updateStateOnServer(key='Current_From_Period', value="")
+            return
+
+    ########################################
+    # History Store
+    ########################################
+
+    # Rates and consumption are kept as JSON files in the plugin preferences folder keyed by the UTC period
+    # so that more than the current day can be used for comparisons
+
+    def historyFolder(self):
+        folder = "{}/Preferences/Plugins/{}".format(indigo.server.getInstallFolderPath(), self.pluginId)
+        if not os.path.isdir(folder):
+            os.mkdir(folder)
+        return folder
+
+    def loadHistory(self, name):
+        with self.historyLock:
+            if name not in self.historyCache:
+                filepath = self.historyFolder() + "/" + name + ".json"
+                try:
+                    with open(filepath, 'r') as file:
+                        self.historyCache[name] = json.load(file)
+                except IOError:
+                    self.historyCache[name] = {}
+                except ValueError:
+                    self.errorLog("History file " + filepath + " is corrupt, starting a new history")
+                    self.historyCache[name] = {}
+            return self.historyCache[name]
+
+    def storeHistory(self, name, entries):
+        # The history is replaced rather than changed in place so callers holding the previous copy can keep
+        # iterating it, and written to a temporary file first so the file is never left half written
+        with self.historyLock:
+            history = dict(self.loadHistory(name))
+            history.update(entries)
+            filepath = self.historyFolder() + "/" + name + ".json"
+            with open(filepath + ".tmp", 'w') as file:
+                json.dump(history, file)
+            os.rename(filepath + ".tmp", filepath)
+            self.historyCache[name] = history
+        self.debugLog("Stored " + str(len(entries)) + " entries in history " + name)
+
+    # The product and tariff codes are kept in the device so the rate history (stored under the tariff code) only
+    # moves to a new tariff when pinTariff changes them.  Devices from before this use the fallback product
+
+    def productCode(self, device):
+        return device.pluginProps.get('product_code', "") or PRODUCT_FAMILIES[device.deviceTypeId][2]
+
+    def tariffCode(self, device):
+        # The Tariff code is built from the Grid Supply Point (gsp) and the product code
+        # unless the catalog holds the published code for the region
+        return device.pluginProps.get('tariff_code', "") or \
+            "E-1R-" + self.productCode(device) + "-" + device.pluginProps['device_gsp']
+
+    def resolveTariff(self, device):
+        # The current product and tariff codes for the device from the cached catalog, so no API call is needed
+        family, direction, fallback = PRODUCT_FAMILIES[device.deviceTypeId]
+        catalog = self.loadHistory("products")
+        product_code = current_product(catalog, family, direction,
+                                       datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")) or fallback
+        product = catalog.get('products', {}).get(product_code, {})
+        return product_code, product.get('regions', {}).get(device.pluginProps['device_gsp'],
+                                                            "E-1R-" + product_code + "-" + device.pluginProps['device_gsp'])
+
+    def pinTariff(self, device):
+        # Move the device to the catalog's current product, each tariff keeps its own rate history and the periods
+        # the device held each earlier tariff are recorded so costs can be read across the change
+        # Until the catalog has been fetched the device keeps the codes it has
+        if device.pluginProps.get('tariff_code', "") != "" and not self.loadHistory("products").get('fetched'):
+            return
+        old_tariff_code = self.tariffCode(device)
+        product_code, tariff_code = self.resolveTariff(device)
+        if product_code == device.pluginProps.get('product_code', "") and tariff_code == old_tariff_code:
+            return
+        updatedProps = device.pluginProps
+        if tariff_code != old_tariff_code:
+            tariff_history = json.loads(updatedProps.get('tariff_history', "[]"))
+            changed = local_day_keys(datetime.datetime.now().date())[0][1]
+            tariff_history.append([tariff_history[-1][1] if tariff_history else "", changed, old_tariff_code])
+            updatedProps['tariff_history'] = json.dumps(tariff_history)
+            self.bandTimelines.pop(device.id, None)
+            indigo.server.log("Tariff for " + device.name + " changed from " + old_tariff_code + " to " + tariff_code)
+        updatedProps['product_code'] = product_code
+        updatedProps['tariff_code'] = tariff_code
+        device.replacePluginPropsOnServer(updatedProps)
+        device.refreshFromServer()
+
+    def tariffAgreements(self, device):
+        # The tariffs a rate device has held as sorted [(from key, to key or None, tariff code)], as for agreement_rates
+        agreements = [tuple(agreement) for agreement in json.loads(device.pluginProps.get('tariff_history', "[]"))]
+        agreements.append((agreements[-1][1] if agreements else "", None, self.tariffCode(device)))
+        return agreements
+
+    def consumptionHistoryName(self, device):
+        return "consumption-" + device.pluginProps['meter_point'] + "-" + device.pluginProps['meter_serial']
+
+    def consumptionRates(self, device, keys):
+        # The rates used to cost a meter's consumption for the given periods, empty if the meter is not costed
+        # If the account has been discovered each period uses the tariff agreed at the time, and the linked rate
+        # device for periods the agreed tariff has no stored rates for (its series is only filled by recosting)
+        # The rate device's rates are those of the tariff it held in each period
+        if device.pluginProps['meter_type'] != 'electricity' or not device.pluginProps.get('calc_costs_yest', False):
+            return {}
+        try:
+            tariff_device = indigo.devices[int(device.pluginProps["tariff_device"])]
+            device_rates = agreement_rates(sorted(keys), self.tariffAgreements(tariff_device),
+                                           lambda tariff_code: self.loadHistory("rates-" + tariff_code))
+        except:
+            device_rates = {}
+        agreements = self.meterAgreements(device)
+        if not agreements:
+            return device_rates
+        rates = agreement_rates(sorted(keys), agreements, lambda tariff_code: self.loadHistory("rates-" + tariff_code))
+        for key in keys:
+            if key not in rates and key in device_rates:
+                rates[key] = device_rates[key]
+        return rates
+
+    def meterAgreements(self, device):
+        # Tariff agreements for the meter point from the cached account, as sorted [(from key, to key or None, tariff code)]
+        for meter_type, meter_point, serial, is_export, agreements, address in self.accountMeters(self.accountDetails()):
+            if meter_point == device.pluginProps['meter_point']:
+                return sorted((slot_key(agreement['valid_from']),
+                               slot_key(agreement['valid_to']) if agreement.get('valid_to') else None,
+                               agreement['tariff_code']) for agreement in agreements)
+        return []
+
+    def fetchRateSeries(self, tariff_code, from_key, to_key):
+        # Store the unit rates of any single rate tariff for a range of periods, expanding longer rate periods
+        # (e.g. a fixed tariff) into half hours so they can be looked up in the same way as Agile rates
+        match = re.match(r"^([EG])-1R-(.+)-([A-P])$", tariff_code)
+        if match is None:
+            self.errorLog("Unable to cost periods on " + tariff_code + " - only single rate tariffs are supported")
+            return
+        if match.group(1) == "E":
+            fuel = "/electricity-tariffs/"
+        else:
+            fuel = "/gas-tariffs/"
+        url = BASE_URL + "/products/" + match.group(2) + fuel + tariff_code + "/standard-unit-rates/?period_from=" + \
+              from_key + "&period_to=" + to_key + "&page_size=1500"
+        series = {}
+        while url:
+            response = self.apiGet(url)
+            response.raise_for_status()
+            results_json = response.json()
+            for rates in results_json['results']:
+                if rates.get('payment_method') == "NON_DIRECT_DEBIT":
+                    continue
+                key = max(slot_key(rates['valid_from']), from_key)
+                if rates.get('valid_to'):
+                    end_key = min(slot_key(rates['valid_to']), to_key)
+                else:
+                    end_key = to_key
+                while key < end_key:
+                    series[key] = rates['value_inc_vat']
+                    key = period_after(key)
+            url = results_json.get('next')
+        self.storeHistory("rates-" + tariff_code, series)
+
+    def recostConsumption(self, pluginAction, device):
+        # Recost the whole consumption history using the tariff agreed in each period
+        agreements = self.meterAgreements(device)
+        if not agreements:
+            self.errorLog("No tariff agreements known for " + device.name + " - run account discovery from the plugins menu first")
+            return ()
+        name = self.consumptionHistoryName(device)
+        history = self.loadHistory(name)
+        if not history:
+            self.errorLog("No consumption history stored yet for " + device.name)
+            return ()
+        keys = sorted(history)
+        last_key = period_after(keys[-1])
+        # Fetch the rates for any part of an agreement that the store does not already cover
+        for valid_from, valid_to, tariff_code in agreements:
+            from_key = max(valid_from, keys[0])
+            to_key = min(valid_to or last_key, last_key)
+            if from_key >= to_key:
+                continue
+            series = self.loadHistory("rates-" + tariff_code)
+            if any(key not in series for key in keys[bisect.bisect_left(keys, from_key):bisect.bisect_left(keys, to_key)]):
+                try:
+                    self.fetchRateSeries(tariff_code, from_key, to_key)
+                except Exception as err:
+                    self.errorLog("Octopus API - Unable to get the rates for " + tariff_code + " " + str(err))
+        started = time.time()
+        rates = self.consumptionRates(device, keys)
+        costs = dict((key, round(history[key] * rates[key], 4)) for key in keys if key in rates)
+        self.storeHistory("cost-" + name, costs)
+        # Rebuild the rolling totals with the corrected costs
+        self.consumptionRings.pop(name, None)
+        device.updateStatesOnServer(self.consumptionIngested(device, {}))
+        indigo.server.log("Recosted " + str(len(costs)) + " periods for " + device.name + " in " +
+                          "%.2f" % (time.time() - started) + " seconds, total £" + "%.2f" % (sum(costs.values()) / 100) +
+                          ", " + str(len(keys) - len(costs)) + " periods without a rate")
+        return ()
+
+    def consumptionRing(self, device):
+        # Build the ring once from the stored history, after that it is only added to as new consumption arrives
+        name = self.consumptionHistoryName(device)
+        if name not in self.consumptionRings:
+            ring = ConsumptionRing()
+            history = self.loadHistory(name)
+            rates = self.consumptionRates(device, history.keys())
+            for key in sorted(history):
+                day, slot = local_day_slot(key)
+                ring.add(day, slot, history[key], history[key] * rates.get(key, 0.0))
+            self.consumptionRings[name] = ring
+        return self.consumptionRings[name]
+
+    def consumptionForecast(self, device):
+        name = self.consumptionHistoryName(device)
+        if name not in self.consumptionForecasts:
+            forecast = ConsumptionForecast()
+            for day, slots in group_by_local_day(self.loadHistory(name)):
+                forecast.add_day(day, slots)
+            self.consumptionForecasts[name] = forecast
+        return self.consumptionForecasts[name]
+
+    def updateForecast(self, device):
+        # Expected usage for tomorrow, costed once tomorrow's rates are published
+        # The shift saving is what moving the usage above the day's lowest slot into the cheapest 4 hours would save
+        tomorrow = datetime.datetime.now().date() + datetime.timedelta(days=1)
+        tomorrow_keys = local_day_keys(tomorrow)
+        rates = self.consumptionRates(device, [key for slot, key in tomorrow_keys])
+        tomorrow_rates = [(slot, rates[key]) for slot, key in tomorrow_keys if key in rates]
+        forecast_date = str(tomorrow) + " (" + str(len(tomorrow_rates)) + " rates)"
+        if device.states.get('Forecast_Date') == forecast_date:
+            return
+        forecast = self.consumptionForecast(device)
+        expected = [forecast.expected(tomorrow, slot) for slot, key in tomorrow_keys]
+        if None in expected:
+            self.debugLog("Not enough consumption history to forecast tomorrow for " + device.name)
+            return
+        device_states = [{'key': 'Forecast_Tomorrow_kWh', 'value': round(sum(expected), 4), 'decimalPlaces': 2,
+                          'uiValue': str(round(sum(expected), 2)) + " kWh"},
+                         {'key': 'Forecast_Date', 'value': forecast_date}]
+        if len(tomorrow_rates) == len(tomorrow_keys):
+            expected_cost = sum(expected[slot] * rate for slot, rate in tomorrow_rates)
+            lowest_usage = min(expected)
+            flexible_usage = sum(expected) - lowest_usage * len(expected)
+            flexible_cost = sum((expected[slot] - lowest_usage) * rate for slot, rate in tomorrow_rates)
+            cheapest_rates = sorted(rate for slot, rate in tomorrow_rates)[0:8]
+            shift_saving = max(0.0, flexible_cost - flexible_usage * sum(cheapest_rates) / len(cheapest_rates))
+            device_states.append({'key': 'Forecast_Tomorrow_Cost', 'value': round(expected_cost, 4), 'decimalPlaces': 2,
+                                  'uiValue': str(round(expected_cost, 2)) + " p"})
+            device_states.append({'key': 'Forecast_Shift_Saving', 'value': round(shift_saving, 4), 'decimalPlaces': 2,
+                                  'uiValue': str(round(shift_saving, 2)) + " p"})
+        device.updateStatesOnServer(device_states)
+
+    def consumptionBaseload(self, device):
+        name = self.consumptionHistoryName(device)
+        if name not in self.consumptionBaseloads:
+            baseload = BaseloadEstimate()
+            for day, slots in group_by_local_day(self.loadHistory(name)):
+                baseload.add_day(day, slots)
+            self.consumptionBaseloads[name] = baseload
+        return self.consumptionBaseloads[name]
+
+    def consumptionBaseline(self, device, new_entries=None):
+        # Built from the history without the new entries, so that the new days can be scored against it
+        name = self.consumptionHistoryName(device)
+        if name not in self.consumptionBaselines:
+            baseline = SlotBaseline()
+            history = self.loadHistory(name)
+            if new_entries:
+                history = dict((key, usage) for key, usage in history.items() if key not in new_entries)
+            for day, slots in group_by_local_day(history):
+                baseline.add_day(day, slots)
+            self.consumptionBaselines[name] = baseline
+        return self.consumptionBaselines[name]
+
+    def scoreAnomalies(self, device, day, scores):
+        threshold = float(device.pluginProps.get('anomaly_threshold', 5))
+        anomalies = sorted(slot for slot, score in scores.items() if score >= threshold)
+        periods = []
+        for slot, key in local_day_keys(day):
+            if slot in anomalies:
+                periods.append(slot_local_time(key).strftime("%H:%M"))
+        if scores:
+            max_score = max(scores.values())
+        else:
+            max_score = 0.0
+        if anomalies:
+            indigo.server.log("Unusual consumption for " + device.name + " on " + str(day) + " at " + ", ".join(periods))
+            self.fireDeviceEvents("consumptionAnomaly", 'consumption_device', device)
+        return [{'key': 'Anomaly_Count', 'value': len(anomalies)},
+                {'key': 'Anomaly_Score', 'value': round(max_score, 2), 'decimalPlaces': 2},
+                {'key': 'Anomaly_Periods', 'value': ", ".join(periods)},
+                {'key': 'Anomaly_Date', 'value': str(day)}]
+
+    def updateNetCost(self, device):
+        # For an export meter linked to the import meter, the net cost of the most recent day both meters have
+        # reported in full.  SMETS2 meters only report up to 23:00 the day before, so this is often two days ago
+        if not device.pluginProps.get('export_meter', False) or device.pluginProps.get('import_device', "") in ("", "none"):
+            return
+        yesterday = datetime.datetime.now().date() - datetime.timedelta(days=1)
+        earliest = yesterday - datetime.timedelta(days=6)
+        try:
+            earliest = max(earliest, datetime.datetime.strptime(device.states['Net_Date'], "%Y-%m-%d").date() +
+                           datetime.timedelta(days=1))
+        except:
+            pass
+        if earliest > yesterday:
+            return
+        try:
+            import_device = indigo.devices[int(device.pluginProps['import_device'])]
+        except:
+            self.errorLog("Import meter for " + device.name + " not found - please select in device settings")
+            return
+        import_usage = self.loadHistory(self.consumptionHistoryName(import_device))
+        export_usage = self.loadHistory(self.consumptionHistoryName(device))
+        net_day = yesterday
+        while net_day >= earliest:
+            keys = [key for slot, key in local_day_keys(net_day)]
+            if all(key in import_usage and key in export_usage for key in keys):
+                break
+            net_day = net_day - datetime.timedelta(days=1)
+        else:
+            self.debugLog("Waiting for both meters to report a full day before the net cost for " + device.name)
+            return
+        periods, totals = net_import_export(keys, import_usage, self.consumptionRates(import_device, keys),
+                                            export_usage, self.consumptionRates(device, keys))
+        self.storeHistory("net-" + self.consumptionHistoryName(device),
+                          dict((key, round(net_cost, 4)) for key, import_cost, export_earnings, net_cost in periods))
+        if device.pluginProps['Log_Rates']:
+            filepath = self.logFolder() + "/" + str(net_day) + "-" + device.name + "-Net.csv"
+            with open(filepath, 'w') as file:
+                writer = csv.writer(file)
+                writer.writerow(["Period", "Import Cost", "Export Earnings", "Net Cost"])
+                for period in periods:
+                    writer.writerow(period)
+        device.updateStatesOnServer([
+            {'key': 'Import_Daily_Cost', 'value': round(totals[0], 4), 'decimalPlaces': 2, 'uiValue': str(round(totals[0], 2)) + " p"},
+            {'key': 'Export_Daily_Earnings', 'value': round(totals[1], 4), 'decimalPlaces': 2, 'uiValue': str(round(totals[1], 2)) + " p"},
+            {'key': 'Net_Daily_Cost', 'value': round(totals[2], 4), 'decimalPlaces': 2, 'uiValue': str(round(totals[2], 2)) + " p"},
+            {'key': 'Net_Date', 'value': str(net_day)}])
+
+    def consumptionIngested(self, device, entries):
+        # Called with each batch of new consumption {period: kWh} for a meter, returns the rolling total states
+        ring = self.consumptionRing(device)
+        rates = self.consumptionRates(device, entries.keys())
+        for key in sorted(entries):
+            day, slot = local_day_slot(key)
+            ring.add(day, slot, entries[key], entries[key] * rates.get(key, 0.0))
+        forecast = self.consumptionForecast(device)
+        new_days = group_by_local_day(entries)
+        baseline = self.consumptionBaseline(device, entries)
+        anomaly_states = []
+        baseload = self.consumptionBaseload(device)
+        for day, slots in new_days:
+            forecast.add_day(day, slots)
+            baseload.add_day(day, slots)
+            if baseline.last_day is None or day.toordinal() > baseline.last_day:
+                anomaly_states = self.scoreAnomalies(device, day, baseline.score(slots))
+            baseline.add_day(day, slots)
+        device_states = anomaly_states
+        for window, usage_state, cost_state in ((7, 'Usage_7_Days', 'Cost_7_Days'),
+                                                (30, 'Usage_30_Days', 'Cost_30_Days'),
+                                                ('month', 'Usage_Month_To_Date', 'Cost_Month_To_Date')):
+            usage, cost = ring.totals[window]
+            device_states.append({'key': usage_state, 'value': round(usage, 4), 'decimalPlaces': 2})
+            device_states.append({'key': cost_state, 'value': round(cost, 4), 'decimalPlaces': 2,
+                                  'uiValue': str(round(cost, 2)) + " p"})
+        baseload_kw = baseload.kw()
+        if baseload_kw is not None and device.pluginProps['meter_type'] == 'electricity':
+            device_states.append({'key': 'Baseload_kW', 'value': round(baseload_kw, 4), 'decimalPlaces': 3,
+                                  'uiValue': str(round(baseload_kw, 3)) + " kW"})
+            # Cost the baseload at the average unit rate paid over the last 30 days
+            usage, cost = ring.totals[30]
+            if usage > 0 and cost > 0:
+                annual_cost = baseload_kw * 24 * 365 * cost / usage / 100
+                device_states.append({'key': 'Baseload_Annual_Cost', 'value': round(annual_cost, 2), 'decimalPlaces': 2,
+                                      'uiValue': "£" + "%.2f" % annual_cost})
+        return device_states
+
+    def rateHorizon(self, tariff_device, from_period):
+        # All the known rates from the given period onwards, in time order, as a list of (period, rate)
+        rates = self.loadHistory("rates-" + self.tariffCode(tariff_device))
+        return sorted((key, rate) for key, rate in rates.items() if key >= from_period)
+
+    ########################################
+    # Energy Target Charge Planning
+    ########################################
+
+    def updateChargePlan(self, device, tariff_device, current_period):
+        charger_kw = float(device.pluginProps['charger_kw'])
+        target_kwh = float(device.pluginProps['target_kwh'])
+        max_rate = float(device.pluginProps['max_rate'])
+        device_states = []
+
+        # The plan runs until the next ready by time, and the energy delivered resets once it has passed
+        ready_by, deadline, last_period = self.readyBy(device)
+        energy_delivered = device.states['Charge_Energy_Delivered']
+        if device.states['Ready_By'] != "" and current_period >= device.states['Ready_By']:
+            indigo.server.log('Ready by time passed, resetting Charge Energy delivered from ' + str(
+                energy_delivered) + " to 0 for " + device.name)
+            energy_delivered = 0
+            device_states.append({'key': 'Charge_Hours_Delivered', 'value': 0})
+        remaining_kwh = max(target_kwh - energy_delivered, 0)
+
+        # Only re-plan when the stored rates or the target have changed, otherwise the remaining plan still holds
+        rates_history = self.loadHistory("rates-" + self.tariffCode(tariff_device))
+        plan_signature = (len(rates_history), tariff_device.states['API_Today'],
+                          tariff_device.states['API_Afternoon_Refresh'], charger_kw, target_kwh, max_rate, deadline)
+        if device.id not in self.chargePlans or self.chargePlans[device.id][0] != plan_signature:
+            horizon = [(key, rate) for key, rate in self.rateHorizon(tariff_device, current_period) if key < deadline]
+            periods_needed = int(math.ceil(round(remaining_kwh / (charger_kw * 0.5), 6)))
+            affordable = sorted([(rate, key) for key, rate in horizon if rate <= max_rate])
+            plan = dict((key, rate) for rate, key in affordable[0:periods_needed])
+            # Rates are only complete for the plan if they are known right up to the ready by time
+            self.chargePlans[device.id] = (plan_signature, plan, len(plan) >= periods_needed,
+                                           len(horizon) > 0 and horizon[-1][0] >= last_period)
+            indigo.server.log("Planned " + str(len(plan)) + " periods to deliver " + str(round(remaining_kwh, 2)) +
+                              " kWh by " + ready_by.strftime("%H:%M") + " for " + device.name)
+        plan_signature, plan, plan_feasible, rates_available = self.chargePlans[device.id]
+        # The load coordinator schedule replaces the sensor's own plan
+        if device.id in self.coordinatedPlans:
+            plan = self.coordinatedPlans[device.id]
+
+        if current_period in rates_history:
+            current_tariff = rates_history[current_period]
+            device_states.append({'key': 'Current_Electricity_Rate', 'value': current_tariff, 'decimalPlaces': 4,
+                                  'uiValue': str(current_tariff) + "p", 'clearErrorState': True})
+
+        if current_period in plan and energy_delivered < target_kwh:
+            device.updateStateOnServer(key="onOffState", value="on")
+            indigo.server.log("Setting Charge Sensor to ON for " + device.name)
+            energy_delivered = energy_delivered + charger_kw * 0.5
+            device_states.append(
+                {'key': 'Charge_Hours_Delivered', 'value': (device.states['Charge_Hours_Delivered'] + 0.5)})
+        else:
+            device.updateStateOnServer(key="onOffState", value="off")
+            indigo.server.log("Setting Charge Sensor to OFF for " + device.name)
+
+        upcoming = sorted(key for key in plan if key >= current_period)
+        device_states.append({'key': 'Preferred_Periods', 'value': ",".join(upcoming)})
+        device_states.append({'key': 'Preferred_Rates', 'value': ",".join(str(plan[key]) for key in upcoming)})
+        device_states.append({'key': 'Planned_Cost', 'value': sum(plan[key] for key in upcoming) * charger_kw * 0.5,
+                              'decimalPlaces': 2})
+        device_states.append({'key': 'Plan_Feasible', 'value': plan_feasible})
+        device_states.append({'key': 'Rates_Available', 'value': rates_available})
+        device_states.append({'key': 'Charge_Energy_Delivered', 'value': energy_delivered, 'decimalPlaces': 2})
+        device_states.append({'key': 'Ready_By', 'value': deadline, 'uiValue': ready_by.strftime("%H:%M")})
+        device_states.append({'key': 'Current_From_Period', 'value': current_period})
+        device_states.append({'key': 'No_Charge_Above', 'value': device.pluginProps['max_rate']})
+        device_states.append({'key': 'Charge_Hours', 'value': device.pluginProps['energy_hours']})
+        device.updateStatesOnServer(device_states)
+
+    def readyBy(self, device):
+        # Returns the next ready by time (local), and the periods it falls in and the last period before it
+        local_now = datetime.datetime.now()
+        ready_by = datetime.datetime.combine(local_now.date(),
+                                             datetime.datetime.strptime(device.pluginProps['ready_by'], "%H:%M").time())
+        if ready_by <= local_now:
+            ready_by = ready_by + datetime.timedelta(days=1)
+        deadline_utc = ready_by.replace(tzinfo=dateutil.tz.tzlocal()).astimezone(dateutil.tz.tzutc())
+        deadline = deadline_utc.strftime("%Y-%m-%dT%H:%M:%SZ")
+        last_period = (deadline_utc - datetime.timedelta(minutes=30)).strftime("%Y-%m-%dT%H:%M:%SZ")
+        return ready_by, deadline, last_period
+
+    ########################################
+    # Load Coordination
+    ########################################
+
+    def sensorCoordinator(self, sensor):
+        for deviceId in self.deviceList:
+            if indigo.devices[deviceId].deviceTypeId == "load_coordinator" and \
+                    str(sensor.id) in indigo.devices[deviceId].pluginProps.get('charge_sensors', []):
+                return indigo.devices[deviceId]
+        return None
+
+    def chargeDemand(self, sensor, current_period):
+        # Returns (periods the sensor could charge in {period: rate}, periods still needed, charger kW)
+        tariff_device = indigo.devices[int(sensor.pluginProps["tariff_device"])]
+        charger_kw = float(sensor.pluginProps.get('charger_kw', 7) or 7)
+        max_rate = float(sensor.pluginProps['max_rate'])
+        if sensor.pluginProps['night_day'] == 'target':
+            ready_by, deadline, last_period = self.readyBy(sensor)
+            energy_delivered = sensor.states['Charge_Energy_Delivered']
+            if sensor.states['Ready_By'] != "" and current_period >= sensor.states['Ready_By']:
+                energy_delivered = 0
+            remaining_kwh = max(float(sensor.pluginProps['target_kwh']) - energy_delivered, 0)
+            periods_needed = int(math.ceil(round(remaining_kwh / (charger_kw * 0.5), 6)))
+            periods = dict((key, rate) for key, rate in self.rateHorizon(tariff_device, current_period)
+                           if key < deadline and rate <= max_rate)
+        else:
+            charge_periods = {'night': night_charge_periods, 'day': day_charge_periods,
+                              'evening': evening_charge_periods}[sensor.pluginProps['night_day']]
+            periods_needed = max(int(sensor.pluginProps['energy_hours']) * 2 -
+                                 int(sensor.states['Charge_Hours_Delivered'] * 2), 0)
+            periods = dict((rates['valid_from'], rates['value_inc_vat']) for rates in
+                           json.loads(tariff_device.pluginProps['today_rates'])
+                           if rates['valid_from'] >= current_period and rates['value_inc_vat'] <= max_rate and
+                           any(period + ":00" in rates['valid_from'] for period in charge_periods))
+        return periods, periods_needed, charger_kw
+
+    def updateCoordinator(self, device, current_period):
+        # Schedule all the linked charge sensors together, once per half hour
+        if device.states['Current_From_Period'] == current_period:
+            return
+        sensors = []
+        loads = []
+        for sensor_id in device.pluginProps.get('charge_sensors', []):
+            try:
+                sensor = indigo.devices[int(sensor_id)]
+                loads.append(self.chargeDemand(sensor, current_period))
+                sensors.append(sensor)
+            except Exception as err:
+                self.errorLog("Unable to include charge sensor " + str(sensor_id) + " in " + device.name + " " + str(err))
+        capacity_kw = float(device.pluginProps['capacity_kw'])
+        if device.pluginProps['method'] == 'flow':
+            plans = min_cost_flow_load_schedule(loads, capacity_kw)
+        else:
+            plans = greedy_load_schedule(loads, capacity_kw)
+
+        period_load = {}
+        summary = []
+        unmet_periods = 0
+        for sensor, plan, (periods, periods_needed, charger_kw) in zip(sensors, plans, loads):
+            self.coordinatedPlans[sensor.id] = plan
+            for period in plan:
+                period_load[period] = period_load.get(period, 0) + charger_kw
+            unmet_periods += periods_needed - len(plan)
+            summary.append(sensor.name + ": " + str(len(plan)) + "/" + str(periods_needed))
+        if unmet_periods > 0:
+            indigo.server.log(str(unmet_periods) + " charging periods could not be scheduled within " +
+                              str(capacity_kw) + " kW for " + device.name)
+
+        device_states = []
+        device_states.append({'key': 'Current_Load_kW', 'value': period_load.get(current_period, 0), 'decimalPlaces': 1})
+        device_states.append({'key': 'Peak_Load_kW', 'value': max(period_load.values()) if period_load else 0,
+                              'decimalPlaces': 1})
+        device_states.append({'key': 'Unmet_Periods', 'value': unmet_periods})
+        device_states.append({'key': 'Schedule_Summary', 'value': ", ".join(summary)})
+        device_states.append({'key': 'Current_From_Period', 'value': current_period})
+        device.updateStatesOnServer(device_states)
+
+    ########################################
+    # Appliance Scheduling
+    ########################################
+
+    def updateAppliancePlan(self, device, tariff_device):
+        now = datetime.datetime.utcnow()
+        if now.minute > 29:
+            current_period = now.strftime("%Y-%m-%dT%H:30:00Z")
+        else:
+            current_period = now.strftime("%Y-%m-%dT%H:00:00Z")
+        profile = [float(energy) for energy in device.pluginProps['power_profile'].split(",")]
+
+        # The run has to finish by the next run by time (after any run already under way)
+        local_now = datetime.datetime.now()
+        run_by = datetime.datetime.combine(local_now.date(),
+                                           datetime.datetime.strptime(device.pluginProps['run_by'], "%H:%M").time())
+        if run_by <= local_now:
+            run_by = run_by + datetime.timedelta(days=1)
+        deadline = run_by.replace(tzinfo=dateutil.tz.tzlocal()).astimezone(dateutil.tz.tzutc()).strftime(
+            "%Y-%m-%dT%H:%M:%SZ")
+
+        # Keep a run that is in progress or has already finished before this run by time
+        # otherwise only re-plan when the rates or settings have changed
+        plan = self.appliancePlans.get(device.id)
+        running = plan is not None and plan[1] is not None and plan[1] <= current_period < plan[2]
+        finished = plan is not None and plan[2] is not None and plan[2] <= current_period
+        rates_history = self.loadHistory("rates-" + self.tariffCode(tariff_device))
+        plan_signature = (len(rates_history), tariff_device.states['API_Today'],
+                          tariff_device.states['API_Afternoon_Refresh'], tuple(profile), deadline)
+        if finished and plan[0][-1] == deadline:
+            self.debugLog("Run already completed before " + run_by.strftime("%H:%M") + " for " + device.name)
+        elif not running and (plan is None or plan[0] != plan_signature or finished):
+            horizon = [(key, rate) for key, rate in self.rateHorizon(tariff_device, current_period) if key < deadline]
+            start_index, expected_cost = cheapest_contiguous_start(horizon, profile)
+            if start_index is None:
+                plan = (plan_signature, None, None, None)
+                indigo.server.log("Not enough known rates to schedule the run before " + run_by.strftime("%H:%M") +
+                                  " for " + device.name)
+            else:
+                plan = (plan_signature, horizon[start_index][0], period_after(horizon[start_index][0], len(profile)),
+                        expected_cost)
+                indigo.server.log("Scheduled run at " + slot_local_time(plan[1]).strftime("%H:%M") +
+                                  " with expected cost " + str(round(expected_cost, 2)) + "p for " + device.name)
+            self.appliancePlans[device.id] = plan
+            running = plan[1] is not None and plan[1] <= current_period < plan[2]
+        plan_signature, start_period, end_period, expected_cost = plan
+
+        device_states = []
+        if start_period is None:
+            device_states.append({'key': 'Planned_Start', 'value': "No Schedule Available"})
+            device_states.append({'key': 'Planned_End', 'value': ""})
+            device_states.append({'key': 'Expected_Cost', 'value': 0, 'decimalPlaces': 2})
+        else:
+            device_states.append({'key': 'Planned_Start', 'value': start_period,
+                                  'uiValue': slot_local_time(start_period).strftime("%H:%M")})
+            device_states.append({'key': 'Planned_End', 'value': end_period,
+                                  'uiValue': slot_local_time(end_period).strftime("%H:%M")})
+            device_states.append({'key': 'Expected_Cost', 'value': expected_cost, 'decimalPlaces': 2,
+                                  'uiValue': str(round(expected_cost, 2)) + "p"})
+        device.updateStatesOnServer(device_states)
+        if running and not device.states['onOffState']:
+            device.updateStateOnServer(key="onOffState", value="on")
+            indigo.server.log("Starting scheduled run, setting Appliance Scheduler to ON for " + device.name)
+        elif not running and device.states['onOffState']:
+            device.updateStateOnServer(key="onOffState", value="off")
+            indigo.server.log("Scheduled run complete, setting Appliance Scheduler to OFF for " + device.name)
+
+        # Wake exactly at the start or end of the run, and at each half hour to pick up new rates
+        next_half_hour = local_now.replace(minute=(local_now.minute // 30) * 30, second=0, microsecond=0) + \
+            datetime.timedelta(minutes=30)
+        self.deviceTimers[device.id] = next_half_hour
+        for period in (start_period, end_period):
+            if period is not None and period > current_period:
+                self.deviceTimers[device.id] = min(next_half_hour, slot_local_time(period).replace(tzinfo=None))
+
+    ########################################
+    # Battery Optimisation
+    ########################################
+
+    def updateBatteryPlan(self, device, tariff_device):
+        now = datetime.datetime.utcnow()
+        if now.minute > 29:
+            current_period = now.strftime("%Y-%m-%dT%H:30:00Z")
+        else:
+            current_period = now.strftime("%Y-%m-%dT%H:00:00Z")
+        if current_period == device.states['Current_From_Period']:
+            self.debugLog("No need to update Battery " + current_period + " for " + device.name)
+            return
+
+        capacity_kwh = float(device.pluginProps['capacity_kwh'])
+        rates_history = self.loadHistory("rates-" + self.tariffCode(tariff_device))
+        plan_signature = (len(rates_history), tariff_device.states['API_Today'],
+                          tariff_device.states['API_Afternoon_Refresh'])
+        plan = self.batteryPlans.get(device.id)
+        if plan is None or plan[0] != plan_signature or current_period not in plan[1]:
+            horizon = self.rateHorizon(tariff_device, current_period)
+            if not horizon or horizon[0][0] != current_period:
+                self.errorLog("No current rate available to plan the battery for " + device.name)
+                device.setErrorStateOnServer('Rate information not available')
+                return
+            # Carry on from where the previous plan expects the battery to be, unless the actual charge has been set
+            state_of_charge = float(device.states['State_Of_Charge'])
+            if plan is not None and current_period in plan[1]:
+                state_of_charge = plan[3][plan[1].index(current_period)]
+            started = datetime.datetime.now()
+            actions, soc, saving = plan_battery(
+                [rate for key, rate in horizon], capacity_kwh, float(device.pluginProps['max_charge_kw']) * 0.5,
+                float(device.pluginProps['max_discharge_kw']) * 0.5, float(device.pluginProps['efficiency']) / 100,
+                capacity_kwh * float(device.pluginProps['reserve']) / 100, state_of_charge,
+                float(device.pluginProps['soc_step']))
+            plan = (plan_signature, [key for key, rate in horizon], actions, soc, saving)
+            self.batteryPlans[device.id] = plan
+            self.debugLog("Battery plan for " + str(len(horizon)) + " periods took " +
+                          str((datetime.datetime.now() - started).total_seconds()) + "s for " + device.name)
+            indigo.server.log("New battery plan with expected saving of " + str(round(saving, 2)) + "p for " + device.name)
+        plan_signature, periods, actions, soc, saving = plan
+
+        index = periods.index(current_period)
+        next_change = ""
+        for next_index in range(index + 1, len(periods)):
+            if actions[next_index] != actions[index]:
+                next_change = periods[next_index]
+                break
+        charge_periods = [period for period, action in zip(periods, actions) if action == "charge"]
+        discharge_periods = [period for period, action in zip(periods, actions) if action == "discharge"]
+        device_states = []
+        device_states.append({'key': 'Current_Action', 'value': actions[index], 'clearErrorState': True})
+        device_states.append({'key': 'State_Of_Charge', 'value': soc[index], 'decimalPlaces': 2,
+                              'uiValue': str(round(soc[index], 2)) + " kWh"})
+        if next_change != "":
+            device_states.append({'key': 'Next_Action_Change', 'value': next_change,
+                                  'uiValue': slot_local_time(next_change).strftime("%H:%M")})
+        else:
+            device_states.append({'key': 'Next_Action_Change', 'value': "End of known rates"})
+        device_states.append({'key': 'Charge_Periods', 'value': ",".join(charge_periods)})
+        device_states.append({'key': 'Discharge_Periods', 'value': ",".join(discharge_periods)})
+        device_states.append({'key': 'Expected_Saving', 'value': saving, 'decimalPlaces': 2,
+                              'uiValue': str(round(saving, 2)) + "p"})
+        device_states.append({'key': 'Current_From_Period', 'value': current_period})
+        device.updateStatesOnServer(device_states)
+
+    ########################################
+    # Price Bands
+    ########################################
+
+    def rateQuantiles(self, tariff_device, quantiles):
+        # Rolling 30 day quantiles from daily histograms of the rate history in 0.1p bins
+        # The full history is only scanned the first time, after that only the recent days are recounted
+        name = "rates-" + self.tariffCode(tariff_device)
+        history = self.loadHistory(name)
+        today = datetime.datetime.utcnow().date()
+        first_day = str(today - datetime.timedelta(days=30))
+        sketch = self.rateSketches.get(name)
+        if sketch is None:
+            sketch = {}
+            for key, rate in history.items():
+                if key[0:10] >= first_day:
+                    sketch.setdefault(key[0:10], collections.Counter())[int(math.floor(rate * 10))] += 1
+            self.rateSketches[name] = sketch
+        else:
+            for offset in (-1, 0, 1):
+                day = str(today + datetime.timedelta(days=offset))
+                day_histogram = collections.Counter()
+                for hour in range(24):
+                    for minute in ("00", "30"):
+                        key = day + "T" + "%02d" % hour + ":" + minute + ":00Z"
+                        if key in history:
+                            day_histogram[int(math.floor(history[key] * 10))] += 1
+                if day_histogram:
+                    sketch[day] = day_histogram
+            for day in [day for day in sketch if day < first_day]:
+                del sketch[day]
+        histogram = collections.Counter()
+        for day_histogram in sketch.values():
+            histogram.update(day_histogram)
+        return histogram_quantiles(histogram, quantiles, 0.1)
+
+    def priceBandStates(self, tariff_device, current_period):
+        # The band for every known period is worked out once per rate refresh, then looked up at each boundary
+        if tariff_device.id not in self.bandTimelines:
+            thresholds = self.rateQuantiles(tariff_device, [float(tariff_device.pluginProps.get('band_cheap_quantile', 25)),
+                                                            float(tariff_device.pluginProps.get('band_expensive_quantile', 75))])
+            if len(thresholds) < 2:
+                return []
+            band = tariff_device.states.get('Price_Band', "normal")
+            horizon = self.rateHorizon(tariff_device, current_period)
+            self.bandTimelines[tariff_device.id] = (thresholds, band_timeline(
+                horizon, band, thresholds[0], thresholds[1], float(tariff_device.pluginProps.get('band_hysteresis', 0.5))))
+        thresholds, timeline = self.bandTimelines[tariff_device.id]
+        index = bisect.bisect_left(timeline, (current_period,))
+        if index == len(timeline) or timeline[index][0] != current_period:
+            return []
+        band = timeline[index][1]
+        next_band = band
+        next_change = "Unknown"
+        for period, period_band in timeline[index + 1:]:
+            if period_band != band:
+                next_band = period_band
+                next_change = slot_local_time(period).strftime("%Y-%m-%d %H:%M")
+                break
+        return [{'key': 'Price_Band', 'value': band},
+                {'key': 'Next_Band', 'value': next_band},
+                {'key': 'Next_Band_Change', 'value': next_change},
+                {'key': 'Band_Cheap_Threshold', 'value': thresholds[0], 'decimalPlaces': 4},
+                {'key': 'Band_Expensive_Threshold', 'value': thresholds[1], 'decimalPlaces': 4}]
+
+    ########################################
+    # Plugin Events
+    ########################################
+
+    def triggerStartProcessing(self, trigger):
+        self.debugLog("Start processing trigger " + trigger.name)
+        self.triggers[trigger.id] = trigger
+        try:
+            self.scheduleRateEvents(indigo.devices[int(trigger.pluginProps['tariff_device'])])
+            self.scheduleWindowEvents(indigo.devices[int(trigger.pluginProps['tariff_device'])])
+        except Exception as err:
+            self.errorLog("Unable to schedule trigger " + trigger.name + " " + str(err))
+
+    def triggerStopProcessing(self, trigger):
+        self.debugLog("Stop processing trigger " + trigger.name)
+        self.triggers.pop(trigger.id, None)
+        with self.eventLock:
+            self.eventTimers = [(when, trigger_id) for when, trigger_id in self.eventTimers if trigger_id != trigger.id]
+            heapq.heapify(self.eventTimers)
+
+    def fireDueEvents(self, now):
+        due = []
+        with self.eventLock:
+            while self.eventTimers and self.eventTimers[0][0] <= now:
+                due.append(heapq.heappop(self.eventTimers))
+        for when, trigger_id in due:
+            trigger = self.triggers.get(trigger_id)
+            if trigger is not None:
+                indigo.server.log("Firing event " + trigger.name + " scheduled for " + str(when))
+                indigo.trigger.execute(trigger)
+
+    def fireDeviceEvents(self, event_type, device_field, device):
+        # Fire straight away any triggers of this type set up for the device
+        for trigger in list(self.triggers.values()):
+            if trigger.pluginTypeId == event_type and trigger.pluginProps.get(device_field) == str(device.id):
+                indigo.server.log("Firing event " + trigger.name)
+                indigo.trigger.execute(trigger)
+
+    def scheduleEvents(self, trigger_ids, event_times):
+        # Replace any scheduled times for these triggers with the new list of (local time, trigger id)
+        now = datetime.datetime.now()
+        with self.eventLock:
+            self.eventTimers = [(when, trigger_id) for when, trigger_id in self.eventTimers
+                                if trigger_id not in trigger_ids]
+            for when, trigger_id in event_times:
+                if when > now:
+                    self.eventTimers.append((when, trigger_id))
+            heapq.heapify(self.eventTimers)
+
+    def scheduleRateEvents(self, tariff_device):
+        # Work out every future threshold crossing from the known rates once, then leave them to the timer
+        now = datetime.datetime.utcnow()
+        if now.minute > 29:
+            current_period = now.strftime("%Y-%m-%dT%H:30:00Z")
+        else:
+            current_period = now.strftime("%Y-%m-%dT%H:00:00Z")
+        horizon = self.rateHorizon(tariff_device, current_period)
+        trigger_ids = []
+        event_times = []
+        for trigger in list(self.triggers.values()):
+            if trigger.pluginTypeId not in ("rateBelow", "rateAbove", "rateNegative") or \
+                    trigger.pluginProps.get('tariff_device') != str(tariff_device.id):
+                continue
+            if trigger.pluginTypeId == "rateNegative":
+                threshold = 0.0
+            else:
+                threshold = float(trigger.pluginProps['threshold'])
+            if trigger.pluginTypeId == "rateAbove":
+                crossings = rate_crossings(horizon, lambda rate: rate > threshold)
+            else:
+                crossings = rate_crossings(horizon, lambda rate: rate < threshold)
+            trigger_ids.append(trigger.id)
+            for period in crossings:
+                event_times.append((slot_local_time(period).replace(tzinfo=None), trigger.id))
+            self.debugLog("Scheduled " + str(len(crossings)) + " times for " + trigger.name)
+        self.scheduleEvents(trigger_ids, event_times)
+
+    def cheapestWindowStarts(self, tariff_device):
+        # Use the windows from the last refresh, or after a restart the times already held in the device states
+        if tariff_device.id not in self.cheapestWindows:
+            windows = {}
+            for periods, state in ((1, 'lowest_30m_time'), (2, 'lowest_1h_time'), (4, 'lowest_2h_time'),
+                                   (6, 'lowest_3h_time'), (8, 'lowest_4h_time')):
+                try:
+                    windows[periods] = datetime.datetime.strptime(tariff_device.states[state], "%m/%d/%Y, %H:%M:%S")
+                except:
+                    pass
+            self.cheapestWindows[tariff_device.id] = windows
+        return self.cheapestWindows[tariff_device.id]
+
+    def scheduleWindowEvents(self, tariff_device):
+        windows = self.cheapestWindowStarts(tariff_device)
+        trigger_ids = []
+        event_times = []
+        for trigger in list(self.triggers.values()):
+            if trigger.pluginTypeId not in ("windowStart", "windowEnd") or \
+                    trigger.pluginProps.get('tariff_device') != str(tariff_device.id):
+                continue
+            trigger_ids.append(trigger.id)
+            periods = int(trigger.pluginProps['window'])
+            if periods not in windows:
+                continue
+            when = windows[periods] - datetime.timedelta(minutes=int(trigger.pluginProps['lead_minutes']))
+            if trigger.pluginTypeId == "windowEnd":
+                when = when + datetime.timedelta(minutes=30 * periods)
+            event_times.append((when, trigger.id))
+            self.debugLog("Scheduled " + trigger.name + " for " + str(when))
+        self.scheduleEvents(trigger_ids, event_times)
+
+    ########################################
+    # Bill Projection
+    ########################################
+
+    def updateBillProjection(self, device, electricity_device, gas_device, projection_key):
+        # Everything here comes from the running totals held by each meter's ring, so the work does not grow with history
+        today = datetime.datetime.now().date()
+        next_month = (today.replace(day=1) + datetime.timedelta(days=32)).replace(day=1)
+        days_in_month = (next_month - today.replace(day=1)).days
+        days_in_year = (datetime.date(today.year + 1, 1, 1) - datetime.date(today.year, 1, 1)).days
+
+        month_start = today.replace(day=1).toordinal()
+        year_start = datetime.date(today.year, 1, 1).toordinal()
+
+        # Each meter has its standing charges by local day and a charge for the days they do not cover, the Agile
+        # charges change over time while Go and gas have a single charge
+        meters = []
+        try:
+            tariff_device = indigo.devices[int(electricity_device.pluginProps["tariff_device"])]
+            if tariff_device.deviceTypeId in PRODUCT_FAMILIES:
+                electricity_standing_charge = self.standingChargeDays(tariff_device)
+            else:
+                electricity_standing_charge = ([], float(tariff_device.states['Daily_Standing_Charge']))
+        except:
+            electricity_standing_charge = ([], 0.0)
+        meters.append(("Electricity", self.consumptionRing(electricity_device), 1.0, electricity_standing_charge))
+        if gas_device is not None:
+            # Gas is costed from its usage, converted to kWh if the meter reports in cubic metres
+            gas_rate = float(device.pluginProps['gas_unit_rate'])
+            if device.pluginProps.get('gas_units', "m3") == "m3":
+                gas_rate = gas_rate * float(device.pluginProps['gas_conversion'])
+            gas_standing_charge = float(device.pluginProps['gas_standing_charge'])
+            meters.append(("Gas", self.consumptionRing(gas_device), gas_rate, ([], gas_standing_charge)))
+
+        device_states = []
+        month_to_date = 0.0
+        month_projected = 0.0
+        year_to_date = 0.0
+        year_projected = 0.0
+        for fuel, ring, unit_rate, (charge_days, default_charge) in meters:
+            (month_usage, month_cost, month_days), (year_usage, year_cost, year_days) = ring.to_date(today)
+            average_usage, average_cost = ring.daily_average()
+            if fuel == "Gas":
+                month_cost = month_usage * unit_rate
+                year_cost = year_usage * unit_rate
+                average_cost = average_usage * unit_rate
+            # Standing charges for the days held (the days up to the newest day in the ring), and for the rest of
+            # the month and year which are projected
+            month_standing = standing_charge_total(charge_days, default_charge, month_start, month_start + days_in_month)
+            year_standing = standing_charge_total(charge_days, default_charge, year_start, year_start + days_in_year)
+            month_held = year_held = 0.0
+            if month_days:
+                month_held = standing_charge_total(charge_days, default_charge, ring.last_day - month_days + 1,
+                                                   ring.last_day + 1)
+            if year_days:
+                year_held = standing_charge_total(charge_days, default_charge, ring.last_day - year_days + 1,
+                                                  ring.last_day + 1)
+            fuel_month_to_date = (month_cost + month_held) / 100
+            fuel_month_projected = fuel_month_to_date + (average_cost * (days_in_month - month_days) +
+                                                         month_standing - month_held) / 100
+            fuel_year_to_date = (year_cost + year_held) / 100
+            fuel_year_projected = fuel_year_to_date + (average_cost * (days_in_year - year_days) +
+                                                       year_standing - year_held) / 100
+            device_states.append({'key': fuel + '_Month_To_Date', 'value': round(fuel_month_to_date, 2), 'decimalPlaces': 2,
+                                  'uiValue': "£" + "%.2f" % fuel_month_to_date})
+            device_states.append({'key': fuel + '_Month_Projected', 'value': round(fuel_month_projected, 2), 'decimalPlaces': 2,
+                                  'uiValue': "£" + "%.2f" % fuel_month_projected})
+            month_to_date += fuel_month_to_date
+            month_projected += fuel_month_projected
+            year_to_date += fuel_year_to_date
+            year_projected += fuel_year_projected
+
+        device_states.append({'key': 'Month_To_Date', 'value': round(month_to_date, 2), 'decimalPlaces': 2,
+                              'uiValue': "£" + "%.2f" % month_to_date})
+        device_states.append({'key': 'Month_Projected_Bill', 'value': round(month_projected, 2), 'decimalPlaces': 2,
+                              'uiValue': "£" + "%.2f" % month_projected})
+        device_states.append({'key': 'Year_To_Date', 'value': round(year_to_date, 2), 'decimalPlaces': 2,
+                              'uiValue': "£" + "%.2f" % year_to_date})
+        device_states.append({'key': 'Year_Projected_Bill', 'value': round(year_projected, 2), 'decimalPlaces': 2,
+                              'uiValue': "£" + "%.2f" % year_projected})
+        device_states.append({'key': 'Last_Projected', 'value': projection_key})
+        device.updateStatesOnServer(device_states)
+        indigo.server.log("Projected bill for " + device.name + " this month £" + "%.2f" % month_projected +
+                          ", this year £" + "%.2f" % year_projected)
+
+    ########################################
+    # Tariff Comparison
+    ########################################
+
+    def comparisonTariffs(self, device):
+        # Returns a list of (state id prefix, name, rate lookup, daily standing charge lookup) for the tariffs to compare
+        tariffs = []
+        for tariff_id in device.pluginProps.get('tariff_devices', []):
+            try:
+                tariff_device = indigo.devices[int(tariff_id)]
+            except:
+                self.errorLog("Tariff device " + str(tariff_id) + " no longer exists for " + device.name)
+                continue
+            if tariff_device.deviceTypeId == "OctopusEnergyGo":
+                go_standing_charge = float(tariff_device.pluginProps['Go_Standing_Charge'])
+                tariffs.append(("Tariff_" + str(tariff_device.id), tariff_device.name,
+                                self.goRateLookup(tariff_device.pluginProps),
+                                lambda day, charge=go_standing_charge: charge))
+            else:
+                tariffs.append(("Tariff_" + str(tariff_device.id), tariff_device.name,
+                                self.loadHistory("rates-" + self.tariffCode(tariff_device)).get,
+                                self.standingChargeLookup(tariff_device)))
+        if device.pluginProps.get('flat_rate', "") != "":
+            flat_rate = float(device.pluginProps['flat_rate'])
+            flat_standing_charge = float(device.pluginProps.get('flat_standing_charge', 0) or 0)
+            tariffs.append(("Flat_Rate", "Flat Rate", lambda key: flat_rate, lambda day: flat_standing_charge))
+        return tariffs
+
+    def goRateLookup(self, go_props):
+        go_periods = go_options[go_props['Go_Tariff']]
+        go_night_rate = float(go_props['Go_Night_Rate'])
+        go_day_rate = float(go_props['Go_Day_Rate'])
+
+        def go_rate(key):
+            if slot_local_time(key).strftime("From-%H-%M") in go_periods:
+                return go_night_rate
+            return go_day_rate
+
+        return go_rate
+
+    def compareTariffs(self, device, consumption_device):
+        tariffs = self.comparisonTariffs(device)
+        if not tariffs:
+            self.errorLog("No tariffs selected to compare for " + device.name)
+            return
+        device.stateListOrDisplayStateIdChanged()
+        consumption = self.loadHistory(self.consumptionHistoryName(consumption_device))
+        day_costs = compare_tariffs(consumption, [(rate_lookup, standing_lookup) for
+                                                  state_prefix, name, rate_lookup, standing_lookup in tariffs])
+        device_states = [{'key': 'Last_Compared', 'value': consumption_device.states["API_Today"]},
+                         {'key': 'Days_Compared', 'value': len(day_costs)}]
+        if not day_costs:
+            indigo.server.log("No days with rates for every tariff yet, tariff comparison not available for " + device.name)
+            device.updateStatesOnServer(device_states)
+            return
+
+        # Average daily cost per tariff, and monthly totals for the CSV summary
+        daily_averages = []
+        monthly_costs = {}
+        for tariff_index in range(len(tariffs)):
+            daily_averages.append(sum(costs[tariff_index] for costs in day_costs.values()) / len(day_costs))
+        for day, costs in day_costs.items():
+            month_costs = monthly_costs.setdefault(day[0:7], [0.0] * len(tariffs))
+            for tariff_index, cost in enumerate(costs):
+                month_costs[tariff_index] += cost
+
+        for tariff_index, (state_prefix, name, rate_lookup, standing_lookup) in enumerate(tariffs):
+            device_states.append({'key': state_prefix + "_Daily_Cost", 'value': daily_averages[tariff_index],
+                                  'decimalPlaces': 2, 'uiValue': str(round(daily_averages[tariff_index], 2)) + " p"})
+            device_states.append({'key': state_prefix + "_Monthly_Cost", 'value': daily_averages[tariff_index] * 365 / 12,
+                                  'decimalPlaces': 2,
+                                  'uiValue': str(round(daily_averages[tariff_index] * 365 / 12, 2)) + " p"})
+        cheapest = daily_averages.index(min(daily_averages))
+        device_states.append({'key': 'Cheapest_Tariff', 'value': tariffs[cheapest][1]})
+        device.updateStatesOnServer(device_states)
+        indigo.server.log("Compared " + str(len(day_costs)) + " days of consumption, cheapest tariff is " +
+                          tariffs[cheapest][1] + " for " + device.name)
+
+        if device.pluginProps['Log_Rates']:
+            filepath = self.logFolder() + "/" + str(datetime.datetime.now().date()) + "-" + device.name + "-Comparison.csv"
+            with open(filepath, 'w') as file:
+                writer = csv.writer(file)
+                writer.writerow(["Period"] + [name for state_prefix, name, rate_lookup, standing_lookup in tariffs])
+                for month in sorted(monthly_costs):
+                    writer.writerow([month] + [round(cost, 2) for cost in monthly_costs[month]])
+                for day in sorted(day_costs):
+                    writer.writerow([day] + [round(cost, 2) for cost in day_costs[day]])
+
+    def logFolder(self):
+        if self.pluginPrefs['LogFilePath'] == "":
+            self.errorLog("No directory path specified in the Plugin Configuration to save the CSV File")
+            DefaultCSVPath = "{}/Preferences/Plugins/{}".format(indigo.server.getInstallFolderPath(), self.pluginId)
+            self.errorLog("Defaulting to " + DefaultCSVPath)
+            self.pluginPrefs['LogFilePath'] = DefaultCSVPath
+        if not os.path.isdir(self.pluginPrefs['LogFilePath']):
+            os.mkdir(self.pluginPrefs['LogFilePath'])
+        return self.pluginPrefs['LogFilePath']
+
+    def getDeviceStateList(self, device):
+        stateList = indigo.PluginBase.getDeviceStateList(self, device)
+        if device.deviceTypeId == "OctopusEnergy_comparison":
+            # The comparison states depend on which tariffs have been selected
+            for state_prefix, name, rate_lookup, standing_lookup in self.comparisonTariffs(device):
+                stateList.append(self.getDeviceStateDictForNumberType(
+                    state_prefix + "_Daily_Cost", name + " Average Daily Cost", name + " Average Daily Cost"))
+                stateList.append(self.getDeviceStateDictForNumberType(
+                    state_prefix + "_Monthly_Cost", name + " Projected Monthly Cost", name + " Projected Monthly Cost"))
+        return stateList
+
     ########################################
     # UI Validate, Plugin Preferences
     ########################################
@@ -995,6 +3556,22 @@ class Plugin(indigo.PluginBase):
             errorsDict = indigo.Dict()
             errorsDict['Capped_Rate'] = "Invalid entry for Capped Rate - must be a number"
             return False, valuesDict, errorsDict
+        try:
+            if float(valuesDict.get('apiRateLimit', 60)) <= 0:
+                raise Exception
+        except:
+            self.errorLog("Invalid entry for API Request Limit - must be a number greater than 0")
+            errorsDict = indigo.Dict()
+            errorsDict['apiRateLimit'] = "Invalid entry for API Request Limit - must be a number greater than 0"
+            return False, valuesDict, errorsDict
+        with self.apiLock:
+            self.apiBuckets = {}
+        if valuesDict.get('account_number', "") != "" and (
+                not valuesDict['account_number'].startswith("A-") or valuesDict.get('account_api_key', "") == ""):
+            self.errorLog("Invalid entry for Account - the number starts A- and the API key is needed")
+            errorsDict = indigo.Dict()
+            errorsDict['account_number'] = "The account number starts A- and the API key must also be entered"
+            return False, valuesDict, errorsDict
         if valuesDict['LogFilePath'] != "":
             if not os.path.isdir(valuesDict['LogFilePath']):
                 errorsDict = indigo.Dict()
@@ -1014,17 +3591,156 @@ class Plugin(indigo.PluginBase):
     def validateDeviceConfigUi(self, valuesDict, typeId, device):
         if typeId == "OctopusEnergyGo":
             valuesDict['address'] = valuesDict['Go_Tariff']
+            # Rates or the Go variant may have changed, so don't wait for the next scheduled rate change
+            self.deviceTimers.pop(device, None)
+            if device in self.deviceList:
+                indigo.devices[device].updateStateOnServer(key='Current_From_Period', value='API Refresh Requested')
         if typeId == "OctopusEnergy_consumption":
+            try:
+                if float(valuesDict['anomaly_threshold']) <= 0:
+                    raise Exception
+            except:
+                self.errorLog("Invalid entry for Anomaly Threshold - must be a number greater than 0")
+                errorsDict = indigo.Dict()
+                errorsDict['anomaly_threshold'] = "Invalid entry for Anomaly Threshold - must be a number greater than 0"
+                return False, valuesDict, errorsDict
+            return True, valuesDict
+        if typeId == "load_coordinator":
+            try:
+                if float(valuesDict['capacity_kw']) <= 0:
+                    raise Exception
+            except:
+                self.errorLog("Invalid entry for Supply Capacity - must be a number greater than 0")
+                errorsDict = indigo.Dict()
+                errorsDict['capacity_kw'] = "Invalid entry for Supply Capacity - must be a number greater than 0"
+                return False, valuesDict, errorsDict
+            # Re-schedule with the new settings on the next cycle
+            valuesDict['address'] = str(valuesDict['capacity_kw']) + " kW"
+            if device in self.deviceList:
+                for sensor_id in indigo.devices[device].pluginProps.get('charge_sensors', []):
+                    self.coordinatedPlans.pop(int(sensor_id), None)
+                indigo.devices[device].updateStateOnServer(key='Current_From_Period', value='Settings Updated')
+            return True, valuesDict
+        if typeId == "battery_optimizer":
+            errorsDict = indigo.Dict()
+            for field in ('capacity_kwh', 'max_charge_kw', 'max_discharge_kw', 'soc_step'):
+                try:
+                    if float(valuesDict[field]) <= 0:
+                        raise Exception
+                except:
+                    errorsDict[field] = "Must be a number greater than 0"
+            for field in ('efficiency', 'reserve'):
+                try:
+                    if not 0 <= float(valuesDict[field]) <= 100:
+                        raise Exception
+                except:
+                    errorsDict[field] = "Must be a percentage from 0 to 100"
+            if 'efficiency' not in errorsDict and float(valuesDict['efficiency']) == 0:
+                errorsDict['efficiency'] = "Must be a percentage greater than 0"
+            if 'capacity_kwh' not in errorsDict and 'soc_step' not in errorsDict and \
+                    float(valuesDict['capacity_kwh']) / float(valuesDict['soc_step']) > 2000:
+                errorsDict['soc_step'] = "Resolution is too fine for the battery capacity"
+            try:
+                tariff_device = indigo.devices[int(valuesDict["tariff_device"])]
+            except:
+                errorsDict['tariff_device'] = "Select the Agile Rate Device"
+            if len(errorsDict) > 0:
+                self.errorLog("Invalid entry for Battery Optimiser settings")
+                return False, valuesDict, errorsDict
+            # Re-plan with the new settings on the next cycle
+            self.batteryPlans.pop(device, None)
+            valuesDict['address'] = "Battery Optimiser"
+            if device in self.deviceList:
+                indigo.devices[device].updateStateOnServer(key='Current_From_Period', value='Settings Updated')
+            return True, valuesDict
+        if typeId == "appliance_scheduler":
+            errorsDict = indigo.Dict()
+            try:
+                profile = [float(energy) for energy in valuesDict['power_profile'].split(",")]
+                if min(profile) < 0:
+                    raise Exception
+            except:
+                errorsDict['power_profile'] = "Must be a comma separated list of the kWh used in each half hour of the run"
+            try:
+                datetime.datetime.strptime(valuesDict['run_by'], "%H:%M")
+            except:
+                errorsDict['run_by'] = "Invalid entry for Run By - must be a time as HH:MM"
+            try:
+                tariff_device = indigo.devices[int(valuesDict["tariff_device"])]
+            except:
+                errorsDict['tariff_device'] = "Select the Agile Rate Device"
+            if len(errorsDict) > 0:
+                self.errorLog("Invalid entry for Appliance Scheduler settings")
+                return False, valuesDict, errorsDict
+            # Re-plan with the new settings on the next cycle
+            self.appliancePlans.pop(device, None)
+            self.deviceTimers.pop(device, None)
+            valuesDict['address'] = "Appliance Scheduler"
+            return True, valuesDict
+        if typeId == "bill_projection":
+            errorsDict = indigo.Dict()
+            try:
+                consumption_device = indigo.devices[int(valuesDict["consumption_device"])]
+                if not consumption_device.pluginProps['calc_costs_yest']:
+                    errorsDict['consumption_device'] = "The consumption device must calculate costs against a tariff device"
+            except:
+                errorsDict['consumption_device'] = "Select the electricity consumption device"
+            if valuesDict.get('gas_device', "") not in ("", "none"):
+                try:
+                    gas_unit_rate = float(valuesDict['gas_unit_rate'])
+                    gas_standing_charge = float(valuesDict['gas_standing_charge'])
+                    gas_conversion = float(valuesDict['gas_conversion'])
+                except:
+                    errorsDict['gas_unit_rate'] = "Invalid entry for Gas Rates - must be whole or decimal numbers"
+            if len(errorsDict) > 0:
+                self.errorLog("Invalid entry for Bill Projection settings")
+                return False, valuesDict, errorsDict
+            valuesDict['address'] = "Bill Projection"
+            if device in self.deviceList:
+                indigo.devices[device].updateStateOnServer(key='Last_Projected', value='Projection Requested')
+            return True, valuesDict
+        if typeId == "OctopusEnergy_comparison":
+            try:
+                consumption_device = indigo.devices[int(valuesDict["consumption_device"])]
+            except:
+                self.errorLog("No consumption device selected")
+                errorsDict = indigo.Dict()
+                errorsDict['consumption_device'] = "Select the consumption device to compare"
+                return False, valuesDict, errorsDict
+            if valuesDict['flat_rate'] != "":
+                try:
+                    flat_rate = float(valuesDict['flat_rate'])
+                    flat_standing_charge = float(valuesDict['flat_standing_charge'] or 0)
+                except:
+                    self.errorLog("Invalid entry for Flat Rate - must be a whole or decimal number")
+                    errorsDict = indigo.Dict()
+                    errorsDict['flat_rate'] = "Invalid entry for Flat Rate or Standing Charge - must be a whole or decimal number"
+                    return False, valuesDict, errorsDict
+            # Recompare with the new selection on the next cycle
+            valuesDict['address'] = "Tariff Comparison"
+            if device in self.deviceList:
+                indigo.devices[device].updateStateOnServer(key='Last_Compared', value='Comparison Requested')
             return True, valuesDict
-        if typeId == "OctopusEnergy":
+        if typeId in ("OctopusEnergy", "OctopusEnergyExport"):
+            try:
+                cheap_quantile = float(valuesDict['band_cheap_quantile'])
+                expensive_quantile = float(valuesDict['band_expensive_quantile'])
+                hysteresis = float(valuesDict['band_hysteresis'])
+                if not 0 < cheap_quantile < expensive_quantile < 100 or hysteresis < 0:
+                    raise ValueError
+            except:
+                self.errorLog("Invalid entry for Price Band settings")
+                errorsDict = indigo.Dict()
+                errorsDict['band_cheap_quantile'] = "Quantiles must be between 0 and 100 with Cheap below Expensive, and Hysteresis must not be negative"
+                return False, valuesDict, errorsDict
+            self.bandTimelines.pop(device, None)
             if not (valuesDict['Device_Postcode']):
                 self.errorLog("Postcode Cannot Be Empty")
                 errorsDict = indigo.Dict()
                 errorsDict['Device_Postcode'] = "Postcode Cannot Be Empty"
                 return False, valuesDict, errorsDict
             try:
-                response = requests.get(BASE_URL + GET_GSP + valuesDict['Device_Postcode'],
-                                        timeout=float(self.pluginPrefs['requeststimeout']))
+                response = self.apiGet(BASE_URL + GET_GSP + valuesDict['Device_Postcode'])
                 response.raise_for_status()
             except requests.exceptions.HTTPError as err:
 
@@ -1057,15 +3773,17 @@ class Plugin(indigo.PluginBase):
                 return False, valuesDict, errorsDict
             valuesDict['address'] = valuesDict['Device_Postcode']
         if typeId == "charge_sensor":
+            # Charging hours are only used by the night, day and evening buckets, an energy target plans its own
             try:
-                charge_hours = int(valuesDict['energy_hours'])
-                if charge_hours < 1 or charge_hours > 10:
-                    raise Exception
+                if valuesDict['night_day'] != 'target':
+                    charge_hours = int(valuesDict['energy_hours'])
+                    if charge_hours < 1 or charge_hours > 10:
+                        raise Exception
             except:
-                self.errorLog("Invalid entry for Charging Hours - must be a number greater or equal 1 and less than 12")
+                self.errorLog("Invalid entry for Charging Hours - must be a number from 1 to 10")
                 errorsDict = indigo.Dict()
                 errorsDict[
-                    'energy_hours'] = "Invalid entry for Charging Hours - must be a number greater or equal to 1 and less than 12"
+                    'energy_hours'] = "Invalid entry for Charging Hours - must be a number from 1 to 10"
                 return False, valuesDict, errorsDict
             try:
                 max_rate = float(valuesDict['max_rate'])
@@ -1076,6 +3794,28 @@ class Plugin(indigo.PluginBase):
                 errorsDict['max_rate'] = "Invalid entry for Max Rate - must be a whole or decimal number"
                 return False, valuesDict, errorsDict
 
+            if valuesDict['night_day'] == 'target':
+                errorsDict = indigo.Dict()
+                try:
+                    if float(valuesDict['target_kwh']) <= 0:
+                        raise Exception
+                except:
+                    errorsDict['target_kwh'] = "Invalid entry for Energy Target - must be a number greater than 0"
+                try:
+                    if float(valuesDict['charger_kw']) <= 0:
+                        raise Exception
+                except:
+                    errorsDict['charger_kw'] = "Invalid entry for Charger Power - must be a number greater than 0"
+                try:
+                    datetime.datetime.strptime(valuesDict['ready_by'], "%H:%M")
+                except:
+                    errorsDict['ready_by'] = "Invalid entry for Ready By - must be a time as HH:MM"
+                if len(errorsDict) > 0:
+                    self.errorLog("Invalid entry for Energy Target settings")
+                    return False, valuesDict, errorsDict
+                # Re-plan with the new settings on the next cycle
+                self.chargePlans.pop(device, None)
+
             try:
                 tariff_device = indigo.devices[int(valuesDict["tariff_device"])]
             except:
@@ -1086,6 +3826,39 @@ class Plugin(indigo.PluginBase):
 
         return True, valuesDict
 
+    ########################################
+    # UI Validate, Event Config
+    ########################################
+
+    def validateEventConfigUi(self, valuesDict, typeId, eventId):
+        errorsDict = indigo.Dict()
+        if typeId == "consumptionAnomaly":
+            try:
+                consumption_device = indigo.devices[int(valuesDict["consumption_device"])]
+            except:
+                errorsDict['consumption_device'] = "Select the Consumption Device"
+        else:
+            try:
+                tariff_device = indigo.devices[int(valuesDict["tariff_device"])]
+            except:
+                errorsDict['tariff_device'] = "Select the Agile Rate Device"
+        if typeId in ("rateBelow", "rateAbove"):
+            try:
+                threshold = float(valuesDict['threshold'])
+            except:
+                errorsDict['threshold'] = "Invalid entry for Threshold - must be a whole or decimal number"
+        if typeId in ("windowStart", "windowEnd"):
+            try:
+                lead_minutes = int(valuesDict['lead_minutes'])
+                if lead_minutes < 0:
+                    raise ValueError
+            except:
+                errorsDict['lead_minutes'] = "Invalid entry for Lead Time - must be a whole number of minutes"
+        if len(errorsDict) > 0:
+            self.errorLog("Invalid entry for Event settings")
+            return False, valuesDict, errorsDict
+        return True, valuesDict
+
         ########################################
         # UI Validate, Action Config
         ########################################
@@ -1107,10 +3880,56 @@ class Plugin(indigo.PluginBase):
                 if charge_hours < 1 or charge_hours > 10:
                     raise Exception
             except:
-                self.errorLog("Invalid entry for Charging Hours - must be a number greater or equal 1 and less than 12")
+                self.errorLog("Invalid entry for Charging Hours - must be a number from 1 to 10")
                 errorsDict = indigo.Dict()
                 errorsDict[
-                    'energy_hours'] = "Invalid entry for Charging Hours - must be a number greater or equal to 1 and less than 12"
+                    'energy_hours'] = "Invalid entry for Charging Hours - must be a number from 1 to 10"
+                return False, valuesDict, errorsDict
+        if typeId == "update_charge_target":
+            errorsDict = indigo.Dict()
+            try:
+                if float(valuesDict['target_kwh']) <= 0:
+                    raise Exception
+            except:
+                errorsDict['target_kwh'] = "Invalid entry for Energy Target - must be a number greater than 0"
+            try:
+                datetime.datetime.strptime(valuesDict['ready_by'], "%H:%M")
+            except:
+                errorsDict['ready_by'] = "Invalid entry for Ready By - must be a time as HH:MM"
+            if len(errorsDict) > 0:
+                self.errorLog("Invalid entry for Energy Target settings")
+                return False, valuesDict, errorsDict
+        if typeId == "set_battery_soc":
+            try:
+                if float(valuesDict['state_of_charge']) < 0:
+                    raise Exception
+            except:
+                self.errorLog("Invalid entry for State of Charge - must be a number")
+                errorsDict = indigo.Dict()
+                errorsDict['state_of_charge'] = "Invalid entry for State of Charge - must be a number of kWh"
+                return False, valuesDict, errorsDict
+        if typeId == "backtest_charge_sensor":
+            errorsDict = indigo.Dict()
+            try:
+                for charge_hours in valuesDict['energy_hours_grid'].split(","):
+                    if int(charge_hours) < 1 or int(charge_hours) > 10:
+                        raise Exception
+            except:
+                errorsDict['energy_hours_grid'] = "Must be a comma separated list of whole numbers from 1 to 10"
+            try:
+                for max_rate in valuesDict['max_rate_grid'].split(","):
+                    float(max_rate)
+            except:
+                errorsDict['max_rate_grid'] = "Must be a comma separated list of whole or decimal numbers"
+            if len(valuesDict['night_day_grid']) == 0:
+                errorsDict['night_day_grid'] = "Select at least one charging period"
+            try:
+                if float(valuesDict['charger_kw']) <= 0:
+                    raise Exception
+            except:
+                errorsDict['charger_kw'] = "Must be a number greater than 0"
+            if len(errorsDict) > 0:
+                self.errorLog("Invalid entry for Backtest settings")
                 return False, valuesDict, errorsDict
 
         return True, valuesDict
@@ -1133,7 +3952,7 @@ class Plugin(indigo.PluginBase):
 
     def logDumpRates(self):
         for deviceId in self.deviceList:
-            if indigo.devices[deviceId].deviceTypeId != "OctopusEnergy_consumption":
+            if indigo.devices[deviceId].deviceTypeId == "OctopusEnergy":
                 indigo.server.log(indigo.devices[deviceId].name + " Today")
                 indigo.server.log("Period , Tariff")
                 for rates in json.loads(indigo.devices[deviceId].pluginProps['today_rates']):
@@ -1146,8 +3965,29 @@ class Plugin(indigo.PluginBase):
     # Force API refresh on all devices at next cycle
 
     def forceAPIrefresh(self):
+        # A manual refresh tries the API again even if an endpoint's circuit is open
+        with self.apiLock:
+            self.apiCache.clear()
+            self.apiBreakers.clear()
         for deviceId in self.deviceList:
             indigo.server.log(indigo.devices[deviceId].name + " Set for refresh on next cycle")
+            self.deviceTimers.pop(deviceId, None)
+            if indigo.devices[deviceId].deviceTypeId == "OctopusEnergy_comparison":
+                indigo.devices[deviceId].updateStateOnServer(key='Last_Compared', value='API Refresh Requested')
+                continue
+            if indigo.devices[deviceId].deviceTypeId == "bill_projection":
+                indigo.devices[deviceId].updateStateOnServer(key='Last_Projected', value='API Refresh Requested')
+                continue
+            if indigo.devices[deviceId].deviceTypeId == "appliance_scheduler":
+                self.appliancePlans.pop(deviceId, None)
+                continue
+            if indigo.devices[deviceId].deviceTypeId == "battery_optimizer":
+                self.batteryPlans.pop(deviceId, None)
+                indigo.devices[deviceId].updateStateOnServer(key='Current_From_Period', value='')
+                continue
+            if indigo.devices[deviceId].deviceTypeId == "load_coordinator":
+                indigo.devices[deviceId].updateStateOnServer(key='Current_From_Period', value='API Refresh Requested')
+                continue
             if indigo.devices[deviceId].deviceTypeId != "charge_sensor":
                 indigo.devices[deviceId].updateStateOnServer(key='API_Today', value='API Refresh Requested')
             if indigo.devices[deviceId].deviceTypeId != "OctopusEnergy_consumption":
@@ -1170,7 +4010,11 @@ class Plugin(indigo.PluginBase):
         filepath = self.pluginPrefs['LogFilePath'] + "/" + str(
             local_day) + "-" + device.name + "-Action-Today-Rates.csv"
         if device.pluginProps['CSV_engine']:
-            filepath = device.pluginProps['CSV_FilePath'] + "agile_today.csv"
+            # Export rate devices publish to their own file so they do not overwrite the import rates
+            if device.deviceTypeId == "OctopusEnergyExport":
+                filepath = device.pluginProps['CSV_FilePath'] + "agile_export_today.csv"
+            else:
+                filepath = device.pluginProps['CSV_FilePath'] + "agile_today.csv"
         with open(filepath, 'w') as file:
             writer = csv.writer(file)
             writer.writerow(["Period", "Tariff"])
@@ -1220,6 +4064,80 @@ class Plugin(indigo.PluginBase):
         device.updateStateOnServer(key='Charge_Hours', value=pluginAction.props.get('energy_hours'))
         return ()
 
+    # Update Energy Target and Ready By time, the plan is recalculated straight away
+    def chargeSensorTarget(self, pluginAction, device):
+        localPropsCopy = device.pluginProps
+        localPropsCopy['target_kwh'] = pluginAction.props.get('target_kwh')
+        localPropsCopy['ready_by'] = pluginAction.props.get('ready_by')
+        device.replacePluginPropsOnServer(localPropsCopy)
+        device.updateStateOnServer(key='Current_From_Period', value='Charge Target Updated')
+        return ()
+
+    # Set the battery state of charge from the actual battery, the plan is recalculated from it straight away
+    def batterySoc(self, pluginAction, device):
+        state_of_charge = min(float(pluginAction.props.get('state_of_charge')), float(device.pluginProps['capacity_kwh']))
+        device.updateStateOnServer(key='State_Of_Charge', value=state_of_charge)
+        device.updateStateOnServer(key='Current_From_Period', value='State of Charge Updated')
+        self.batteryPlans.pop(device.id, None)
+        return ()
+
+    # Replay the charge sensor over the stored rate history for a grid of settings and report the results
+    def backtestChargeSensor(self, pluginAction, device):
+        try:
+            tariff_device = indigo.devices[int(device.pluginProps["tariff_device"])]
+        except:
+            self.errorLog("No Tariff device associated with the Charge Sensor - please select in device settings for " + device.name)
+            return ()
+        rates = self.loadHistory("rates-" + self.tariffCode(tariff_device))
+        if not rates:
+            self.errorLog("No rate history stored yet for " + tariff_device.name + " to backtest " + device.name)
+            return ()
+        # The sweep can take a while over a long history so it is run off the action thread
+        thread = threading.Thread(target=self.runBacktest, args=(dict(pluginAction.props), device, rates),
+                                  name="Octopus backtest " + device.name)
+        thread.daemon = True
+        thread.start()
+        return ()
+
+    def runBacktest(self, props, device, rates):
+        # Group the stored rates into the local days the tariff device would have held as todays rates
+        days = {}
+        for key, rate in rates.items():
+            days.setdefault(str(slot_local_time(key).date()), []).append((key, rate))
+        days = [(day, days[day]) for day in sorted(days)]
+
+        energy_hours_grid = [int(value) for value in props.get('energy_hours_grid', "").split(",")]
+        max_rate_grid = [float(value) for value in props.get('max_rate_grid', "").split(",")]
+        night_day_grid = list(props.get('night_day_grid', ['night', 'day', 'evening']))
+        charger_kw = float(props.get('charger_kw', 7))
+        configs = [(energy_hours, max_rate, night_day) for energy_hours in energy_hours_grid
+                   for max_rate in max_rate_grid for night_day in night_day_grid]
+
+        started = datetime.datetime.now()
+        charge_periods = {'night': night_charge_periods, 'day': day_charge_periods, 'evening': evening_charge_periods}
+        results = backtester.run_sweep(days, charge_periods, configs, charger_kw)
+        indigo.server.log("Backtested " + str(len(configs)) + " charge sensor settings over " + str(len(days)) +
+                          " days in " + str((datetime.datetime.now() - started).total_seconds()) + "s for " + device.name)
+
+        # Best settings are those that never missed a charge, then the lowest average price
+        results.sort(key=lambda result: (result['missed_days'], result['average_price']))
+        for result in results[0:5]:
+            indigo.server.log("Hours " + str(result['energy_hours']) + " Max Rate " + str(result['max_rate']) + " " +
+                              result['night_day'] + " - Delivered " + str(round(result['energy_delivered'], 1)) +
+                              " kWh at average " + str(round(result['average_price'], 2)) + "p, missed " +
+                              str(result['missed_days']) + " days")
+
+        filepath = self.logFolder() + "/" + str(datetime.datetime.now().date()) + "-" + device.name + "-Backtest.csv"
+        with open(filepath, 'w') as file:
+            writer = csv.writer(file)
+            writer.writerow(["Charge Hours", "Max Rate", "Night Day", "Energy Delivered", "Average Price", "Total Cost",
+                             "Missed Days", "Days"])
+            for result in results:
+                writer.writerow([result['energy_hours'], result['max_rate'], result['night_day'],
+                                 round(result['energy_delivered'], 2), round(result['average_price'], 4),
+                                 round(result['total_cost'], 2), result['missed_days'], result['days']])
+        indigo.server.log("Created CSV file " + filepath + " for device " + device.name)
+
     # Was getting strange behaviour as when I wrote the json to the plugin props the device would restart causing a failed update
     # Found this was intended unless this method was defined.  Now will only restart if the address (postcode) changes.
 
@@ -1228,6 +4146,16 @@ class Plugin(indigo.PluginBase):
             return False
         if origDev.deviceTypeId == "OctopusEnergyGo":
             return False
+        if origDev.deviceTypeId == "OctopusEnergy_comparison":
+            return False
+        if origDev.deviceTypeId == "bill_projection":
+            return False
+        if origDev.deviceTypeId == "appliance_scheduler":
+            return False
+        if origDev.deviceTypeId == "battery_optimizer":
+            return False
+        if origDev.deviceTypeId == "load_coordinator":
+            return False
         if origDev.pluginProps['address'] != newDev.pluginProps['address']:
             return True
         return False
@@ -1235,12 +4163,76 @@ class Plugin(indigo.PluginBase):
     def getTariffDevice(self, filter="", valuesDict=None, typeId="", targetId=0):
 
         retList = []
+        # The filter selects export rate devices ("export") or both import and export ("all")
+        if filter == "export":
+            device_types = ('OctopusEnergyExport',)
+        elif filter == "all":
+            device_types = ('OctopusEnergy', 'OctopusEnergyExport')
+        else:
+            device_types = ('OctopusEnergy',)
         devicePlugin = valuesDict.get("devicePlugin", None)
         for dev in indigo.devices.iter():
             if dev.protocol == indigo.kProtocol.Plugin and \
                     dev.pluginId == "com.barn.indigoplugin.OctopusEnergy" and \
-                    dev.deviceTypeId == 'OctopusEnergy':
+                    dev.deviceTypeId in device_types:
+                retList.append((dev.id, dev.name))
+
+        retList.sort(key=lambda tup: tup[1])
+        return retList
+
+    def getChargeSensorDevice(self, filter="", valuesDict=None, typeId="", targetId=0):
+
+        retList = []
+        for dev in indigo.devices.iter("self.charge_sensor"):
+            retList.append((dev.id, dev.name))
+
+        retList.sort(key=lambda tup: tup[1])
+        return retList
+
+    def getComparisonTariffDevice(self, filter="", valuesDict=None, typeId="", targetId=0):
+
+        retList = []
+        for dev in indigo.devices.iter("self"):
+            if dev.deviceTypeId in ('OctopusEnergy', 'OctopusEnergyGo'):
+                retList.append((dev.id, dev.name))
+
+        retList.sort(key=lambda tup: tup[1])
+        return retList
+
+    def getConsumptionDevice(self, filter="", valuesDict=None, typeId="", targetId=0):
+
+        retList = []
+        for dev in indigo.devices.iter("self"):
+            if dev.deviceTypeId == 'OctopusEnergy_consumption' and dev.pluginProps['meter_type'] == 'electricity' and \
+                    not dev.pluginProps.get('export_meter', False):
+                retList.append((dev.id, dev.name))
+
+        retList.sort(key=lambda tup: tup[1])
+        return retList
+
+    def getMeterDevice(self, filter="", valuesDict=None, typeId="", targetId=0):
+
+        retList = []
+        for dev in indigo.devices.iter("self"):
+            if dev.deviceTypeId == 'OctopusEnergy_consumption':
+                retList.append((dev.id, dev.name))
+
+        retList.sort(key=lambda tup: tup[1])
+        return retList
+
+    def getImportMeterDevice(self, filter="", valuesDict=None, typeId="", targetId=0):
+
+        retList = self.getConsumptionDevice(filter, valuesDict, typeId, targetId)
+        retList.insert(0, ("none", "- No Net Cost -"))
+        return retList
+
+    def getGasConsumptionDevice(self, filter="", valuesDict=None, typeId="", targetId=0):
+
+        retList = []
+        for dev in indigo.devices.iter("self"):
+            if dev.deviceTypeId == 'OctopusEnergy_consumption' and dev.pluginProps['meter_type'] == 'gas':
                 retList.append((dev.id, dev.name))
 
         retList.sort(key=lambda tup: tup[1])
+        retList.insert(0, ("none", "- No Gas Meter -"))
         return retList